@@ -0,0 +1,133 @@
+""" Streaming ROC, precision-recall and FDR-recall statistics
+
+The detection of the true coefficients is accumulated test by test, in
+fixed-resolution histograms of the detection strength -log10(p) of the
+true and null coefficients, so that the memory does not depend on the
+number of tests. The FDR and recall of the selected models are also
+accumulated at a grid of alpha levels.
+"""
+
+import numpy as np
+
+
+def detection_strength(values, size=1., max_strength=20.):
+    """-log10(values / size), clipped to [0, max_strength]
+
+    values are p-values (size=1) or scores (size=p): the smaller, the more
+    significant.
+    """
+    values = np.clip(np.asarray(values, dtype=np.float64) / size,
+                     10. ** - max_strength, 1.)
+    return - np.log10(values)
+
+
+class DetectionAccumulator(object):
+    """ROC, precision-recall and FDR-recall curves, accumulated by test
+
+    Parameters
+    ----------
+    size : float, optional
+        Largest value of the p-values or scores: 1 for p-values, the number
+        of features for scores
+
+    n_bins : int, optional
+        Number of bins of the histograms of detection strength. It sets
+        the resolution of the curves: the thresholds are multiples of
+        max_strength / n_bins in -log10 units.
+
+    max_strength : float, optional
+        Strengths above it (p-values below 10 ** -max_strength) fall in
+        the last bin
+
+    alphas : sequence of float, optional
+        Levels at which the FDR and the recall of the selected models are
+        recorded
+
+    select : callable, optional
+        select(values, alpha) returns the selected model of a test. Defaults
+        to the Benjamini-Hochberg procedure stab_lasso.select_model_fdr.
+    """
+
+    def __init__(self, size=1., n_bins=2000, max_strength=20., alphas=(),
+                 select=None):
+        self.size = size
+        self.n_bins = n_bins
+        self.max_strength = max_strength
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+        if select is None and len(self.alphas):
+            from stab_lasso import select_model_fdr
+            select = select_model_fdr
+        self.select = select
+        self.positives = np.zeros(n_bins, dtype=np.int64)
+        self.negatives = np.zeros(n_bins, dtype=np.int64)
+        self.fdr_sum = np.zeros(len(self.alphas))
+        self.recall_sum = np.zeros(len(self.alphas))
+        self.n_false_discovery_tests = np.zeros(len(self.alphas),
+                                                dtype=np.int64)
+        self.n_tests = 0
+
+    def add(self, values, true_coeff):
+        """Accumulate the p-values (or scores) of one test"""
+        values = np.ravel(values)
+        true_coeff = np.ravel(true_coeff).astype(bool)
+        strength = detection_strength(values, self.size, self.max_strength)
+        bins = np.minimum((strength * (self.n_bins / self.max_strength)
+                           ).astype(np.int64), self.n_bins - 1)
+        self.positives += np.bincount(bins[true_coeff],
+                                      minlength=self.n_bins)
+        self.negatives += np.bincount(bins[~true_coeff],
+                                      minlength=self.n_bins)
+        for i, alpha in enumerate(self.alphas):
+            selected = self.select(values, alpha)
+            n_false = np.sum(selected & ~true_coeff)
+            self.fdr_sum[i] += float(n_false) / max(1., np.sum(selected))
+            self.recall_sum[i] += (float(np.sum(selected & true_coeff)) /
+                                   np.sum(true_coeff))
+            self.n_false_discovery_tests[i] += n_false > 0
+        self.n_tests += 1
+        return self
+
+    def merge(self, other):
+        """Add the counts of another accumulator with the same settings"""
+        self.positives += other.positives
+        self.negatives += other.negatives
+        self.fdr_sum += other.fdr_sum
+        self.recall_sum += other.recall_sum
+        self.n_false_discovery_tests += other.n_false_discovery_tests
+        self.n_tests += other.n_tests
+        return self
+
+    def _cumulative_counts(self):
+        """True and false positives at decreasing thresholds"""
+        tps = np.cumsum(self.positives[::-1])
+        fps = np.cumsum(self.negatives[::-1])
+        thresholds = (np.arange(self.n_bins)[::-1] *
+                      (self.max_strength / self.n_bins))
+        # keep the thresholds where the counts change
+        keep = (self.positives + self.negatives)[::-1] > 0
+        return tps[keep], fps[keep], thresholds[keep]
+
+    def roc_curve(self):
+        """fpr, tpr and the thresholds on the detection strength, like
+        sklearn.metrics.roc_curve"""
+        tps, fps, thresholds = self._cumulative_counts()
+        fpr = np.r_[0, fps] / float(max(1, self.negatives.sum()))
+        tpr = np.r_[0, tps] / float(max(1, self.positives.sum()))
+        return fpr, tpr, np.r_[thresholds[0] + 1, thresholds]
+
+    def precision_recall_curve(self):
+        """precision, recall and the thresholds on the detection strength,
+        like sklearn.metrics.precision_recall_curve"""
+        tps, fps, thresholds = self._cumulative_counts()
+        precision = tps / (tps + fps).astype(np.float64)
+        recall = tps / float(max(1, self.positives.sum()))
+        # by increasing threshold, ending with precision 1 and recall 0
+        return (np.r_[precision[::-1], 1], np.r_[recall[::-1], 0],
+                thresholds[::-1])
+
+    def fdr_recall(self):
+        """alphas, and the average FDR, recall and FWER at each of them"""
+        n_tests = float(max(1, self.n_tests))
+        return (self.alphas, self.fdr_sum / n_tests,
+                self.recall_sum / n_tests,
+                self.n_false_discovery_tests / n_tests)
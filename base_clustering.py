@@ -7,8 +7,11 @@ Author: Andres Hoyos Idrobo
 
 import numpy as np
 from sklearn import clone
-from sklearn.random_projection import BaseRandomProjection
+from sklearn.random_projection import (BaseRandomProjection,
+                                       GaussianRandomProjection,
+                                       SparseRandomProjection)
 from sklearn.feature_extraction import image
+from scipy.sparse import csr_matrix
 import time
 from sklearn.base import TransformerMixin
 from sklearn.utils.validation import check_is_fitted
@@ -17,6 +20,7 @@ from sklearn.utils import check_array
 from sklearn.cluster import AgglomerativeClustering
 from joblib import Memory
 from sklearn.feature_extraction import image
+from mask_geometry import get_mask_geometry
 
 
 
@@ -27,6 +31,69 @@ def _inv_scaling(X, sizes):
     return X / np.sqrt(sizes)
 
 
+def _chunk_size(n_columns, max_elements=2 ** 22):
+    """ Number of rows of a chunk of about max_elements values"""
+    return max(1, max_elements // max(1, n_columns))
+
+
+def _check_data(X, estimator=None):
+    """ check_array, except for memmaps and other sliceable 2D sources
+    (e.g. h5py datasets) which are returned as is, to be read by chunks"""
+    if isinstance(X, np.memmap) or (
+            not isinstance(X, (np.ndarray, list)) and
+            hasattr(X, 'shape') and hasattr(X, '__getitem__') and
+            not hasattr(X, 'tocsr')):
+        if len(X.shape) != 2 or X.shape[1] < 2:
+            raise ValueError("Expected 2D data with at least 2 features, "
+                             "got shape %s" % (X.shape,))
+        return X
+    return check_array(X, accept_sparse=['csr', 'csc', 'coo'],
+                       ensure_min_features=2, estimator=estimator)
+
+
+def sketch_samples(X, n_components, sketch='gaussian', random_state=None):
+    """Compress the sample axis of X with a random projection
+
+    The distances between the columns (voxels) of X are approximately
+    preserved, so that the result can replace X when clustering features.
+
+    X : np.float((n, p))
+        The data. It is read by chunks of samples, so that it can be a
+        np.memmap.
+
+    n_components : int
+        Number of rows of the sketched data. If it is larger than n, X is
+        returned unchanged.
+
+    sketch : string, optional
+        One of 'gaussian' (default) or 'sparse'
+
+    random_state : int or RandomState, optional
+        Seed of the projection
+    """
+    n_samples = X.shape[0]
+    if n_components is None or n_components >= n_samples:
+        return X
+    if sketch == 'gaussian':
+        projection = GaussianRandomProjection(
+            n_components=n_components, random_state=random_state)
+    elif sketch == 'sparse':
+        projection = SparseRandomProjection(
+            n_components=n_components, dense_output=True,
+            random_state=random_state)
+    else:
+        raise ValueError("Unknown sketch type: %s" % sketch)
+    # only the number of samples is needed to draw the projection
+    components = projection.fit(np.zeros((1, n_samples))).components_
+
+    X_sketch = np.zeros((n_components, X.shape[1]))
+    chunk_size = _chunk_size(X.shape[1])
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        X_sketch += components[:, start:stop].dot(np.asarray(X[start:stop]))
+    return X_sketch
+
+
 def _check_parcelation_results(labels, n_clusters):
     """ This function
     """
@@ -95,6 +162,97 @@ class ClusteringTransformer(TransformerMixin):
             Xred = _inv_scaling(Xred, self.sizes_)
         return  Xred[..., inverse]
 
+    def _reduction_matrix(self):
+        """Sparse (n_clusters, p) matrix of the cluster means"""
+        check_is_fitted(self, 'labels_')
+        _, inverse = np.unique(self.labels_, return_inverse=True)
+        p = inverse.shape[0]
+        sizes = np.bincount(inverse).astype(np.float64)
+        return csr_matrix((1. / sizes[inverse], (inverse, np.arange(p))),
+                          shape=(sizes.shape[0], p))
+
+    def iter_transform(self, blocks):
+        """Reduce an iterable of blocks of samples, one block at a time
+
+        The clusters are pooled with the mean. Yields the reduced blocks.
+        """
+        reduction = self._reduction_matrix()
+        for block in blocks:
+            Xred = reduction.dot(np.asarray(block).T).T
+            if self.scaling:
+                Xred = _scaling(Xred, self.sizes_)
+            yield Xred
+
+    def iter_inverse_transform(self, blocks):
+        """Inverse transform an iterable of blocks of reduced samples"""
+        for block in blocks:
+            yield self.inverse_transform(np.asarray(block))
+
+    def transform_chunked(self, X, block_size=1000, out=None, n_samples=None):
+        """Reduce data larger than memory, by blocks of samples
+
+        X : np.float((n, p)), np.memmap, or iterable of blocks of samples
+
+        block_size : int, optional
+            Number of samples read at a time, if X is an array
+
+        out : None, np.float((n, n_clusters)) or string, optional
+            Where the result is written. A string is the filename of a .npy
+            memmap created for the result. Defaults to a new array.
+
+        n_samples : int, optional
+            Total number of samples, needed if X is an iterable of blocks
+            and out is not an array.
+        """
+        n_clusters = len(np.unique(self.labels_))
+        return _write_blocks(self.iter_transform(_iter_blocks(X, block_size)),
+                             n_clusters, _n_rows(X, out, n_samples), out)
+
+    def inverse_transform_chunked(self, Xred, block_size=1000, out=None,
+                                  n_samples=None):
+        """Inverse transform by blocks of samples, see transform_chunked"""
+        return _write_blocks(
+            self.iter_inverse_transform(_iter_blocks(Xred, block_size)),
+            len(self.labels_), _n_rows(Xred, out, n_samples), out)
+
+
+def _iter_blocks(X, block_size):
+    """Blocks of rows of an array, or the blocks of an iterable"""
+    if not hasattr(X, 'shape'):
+        return iter(X)
+    return (X[start:start + block_size]
+            for start in range(0, X.shape[0], block_size))
+
+
+def _n_rows(X, out, n_samples):
+    if n_samples is not None:
+        return n_samples
+    if hasattr(X, 'shape'):
+        return X.shape[0]
+    if hasattr(out, 'shape'):
+        return out.shape[0]
+    raise ValueError("n_samples is needed to allocate the output "
+                     "for an iterable of blocks")
+
+
+def _write_blocks(blocks, n_columns, n_rows, out=None):
+    """Write consecutive blocks of rows into a preallocated output"""
+    if out is None:
+        out = np.empty((n_rows, n_columns))
+    elif isinstance(out, basestring):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64,
+                                        shape=(n_rows, n_columns))
+    elif out.shape != (n_rows, n_columns):
+        raise ValueError("out should have a shape %s, got %s" % (
+            (n_rows, n_columns), out.shape))
+    start = 0
+    for block in blocks:
+        out[start:start + block.shape[0]] = block
+        start += block.shape[0]
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
 
 
 ################################################################################
@@ -122,10 +280,8 @@ class MyFeatureAgglomeration(AgglomerativeClustering, ClusteringTransformer):
                         ensure_min_features=2, estimator=self)
 
         if self.connectivity is None:
-            mask_data = self.masker.mask_img_.get_data().astype(np.bool)
-            n_x, n_y, n_z = mask_data.shape
-            self.connectivity = image.grid_to_graph(n_x=n_x, n_y=n_y, n_z=n_z,
-                                                    mask=mask_data)
+            mask_data = self.masker.mask_img_.get_data()
+            self.connectivity = get_mask_geometry(mask_data).connectivity
         # print X.shape, self.connectivity.shape
         AgglomerativeClustering.fit(self, X.T, **fit_params)
 
@@ -0,0 +1,322 @@
+"""
+Performance benchmarks of the stability lasso
+=============================================
+
+Times (and, if memory_profiler is installed, memory-profiles) the fit of
+StabilityLasso, each inference method, the aggregation of the p-values
+and the FDR selection on simulated data, over a grid of volume shapes,
+sample counts, split counts and cluster sizes.
+
+It also compares the clustering backends (ward, the ReNN linkages and
+the projection() path) on speed and parcel quality, and measures the
+scaling of the threaded stages of the clustering with n_jobs.
+
+Usage::
+
+    python benchmarks.py run results.json
+    python benchmarks.py compare results.json baseline.json
+    python benchmarks.py clustering [table.json]
+    python benchmarks.py threads [table.json]
+
+The comparison flags the stages that got slower (or used more memory)
+than in the baseline, and exits with a non-zero status if there are any.
+"""
+
+import sys
+import json
+import time
+import platform
+import itertools
+import numpy as np
+
+from mask_geometry import get_mask_geometry
+from plot_simulated_data import univariate_simulation, multivariate_simulation
+from large_simulation import brain_mask
+from stab_lasso import (StabilityLasso, pvalues_aggregation, select_model_fdr,
+                        projection)
+from base_clustering import MyFeatureAgglomeration, _fit_method
+from fast_cluster import (ReNN, _edge_weights, _reduce_data,
+                          _random_incidence, _connectivity_to_edges)
+
+SHAPES = [(12, 12, 12), (24, 24, 24), (32, 32, 32), (64, 64, 64)]
+N_SAMPLES = [50, 100, 200]
+N_SPLITS = [1, 20]
+CLUST_SIZES = [10]
+
+MASK_SHAPES = [(12, 12, 12), (24, 24, 24), (40, 40, 40)]
+CLUSTER_RATIOS = [.02, .1]
+
+THREADS_SHAPE = (60, 60, 60)
+N_JOBS = [1, 2, 4, -1]
+
+INFERENCES = ['multivariate_split_pval', 'multivariate_split_scores',
+              'univariate_split_pval']
+
+
+def measure(func, *args, **kwargs):
+    """Run func(*args, **kwargs)
+
+    Returns the result, the wall time in seconds and the peak memory in MB
+    during the call (None if memory_profiler is not installed).
+    """
+    try:
+        from memory_profiler import memory_usage
+    except ImportError:
+        t0 = time.time()
+        result = func(*args, **kwargs)
+        return result, time.time() - t0, None
+
+    t0 = time.time()
+    peak, result = memory_usage((func, args, kwargs), interval=.01,
+                                max_usage=True, retval=True)
+    return result, time.time() - t0, float(np.max(peak))
+
+
+def _record(stages, name, elapsed, memory):
+    stages[name] = {'time': elapsed, 'memory': memory}
+
+
+def benchmark_case(shape, n_samples, n_split, mean_size_clust,
+                   simulation='univariate', theta=.1, split_ratio=.5,
+                   alpha=.05, random_seed=1):
+    """Time every stage of the stability lasso on one simulated dataset"""
+    simulate = (univariate_simulation if simulation == 'univariate'
+                else multivariate_simulation)
+    X, y, _, _, _, _ = simulate(-10, n_samples, shape, random_seed,
+                                modulation=simulation == 'univariate')
+    connectivity = get_mask_geometry(np.ones(shape, dtype=bool)).connectivity
+    n_clusters = int(np.prod(shape) / mean_size_clust)
+
+    stages = {}
+    model = StabilityLasso(theta, n_split=n_split, ratio_split=split_ratio,
+                           n_clusters=n_clusters)
+    _, elapsed, memory = measure(model.fit, X, y, connectivity)
+    _record(stages, 'fit', elapsed, memory)
+
+    for inference in INFERENCES:
+        _, elapsed, memory = measure(getattr(model, inference), X, y)
+        _record(stages, inference, elapsed, memory)
+
+    if n_split > 1:
+        _, elapsed, memory = measure(pvalues_aggregation, model._pvalues)
+        _record(stages, 'aggregation', elapsed, memory)
+
+    _, elapsed, memory = measure(select_model_fdr,
+                                 model._pvalues_aggregated, alpha)
+    _record(stages, 'fdr_selection', elapsed, memory)
+
+    return {'params': {'shape': list(shape), 'n_samples': n_samples,
+                       'n_split': n_split,
+                       'mean_size_clust': mean_size_clust,
+                       'simulation': simulation},
+            'stages': stages}
+
+
+def run_benchmarks(shapes=SHAPES, n_samples=N_SAMPLES, n_splits=N_SPLITS,
+                   clust_sizes=CLUST_SIZES, simulation='univariate',
+                   output=None, verbose=1):
+    """Run benchmark_case over the grid, and write the results as JSON"""
+    results = []
+    for shape, n, n_split, size in itertools.product(
+            shapes, n_samples, n_splits, clust_sizes):
+        result = benchmark_case(shape, n, n_split, size,
+                                simulation=simulation)
+        results.append(result)
+        if verbose:
+            print('%s %s' % (_case_key(result['params']), ', '.join(
+                '%s: %.3fs' % (stage, value['time'])
+                for stage, value in sorted(result['stages'].items()))))
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'machine': platform.node()},
+              'results': results}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return report
+
+
+def _case_key(params):
+    return 'shape=%s n_samples=%d n_split=%d mean_size_clust=%d %s' % (
+        'x'.join(str(s) for s in params['shape']), params['n_samples'],
+        params['n_split'], params['mean_size_clust'], params['simulation'])
+
+
+def compare(report, baseline, tolerance=.2, min_time=.05):
+    """Stages of report that regressed with respect to baseline
+
+    A stage regresses if it is more than (1 + tolerance) times slower and
+    more than min_time seconds slower, or uses (1 + tolerance) times more
+    memory. Returns a list of (case, stage, metric, new, old) tuples.
+    """
+    baseline = dict((_case_key(result['params']), result['stages'])
+                    for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        key = _case_key(result['params'])
+        if key not in baseline:
+            continue
+        for stage, new in sorted(result['stages'].items()):
+            old = baseline[key].get(stage)
+            if old is None:
+                continue
+            if (new['time'] > (1 + tolerance) * old['time'] and
+                    new['time'] - old['time'] > min_time):
+                regressions.append((key, stage, 'time', new['time'],
+                                    old['time']))
+            if (new['memory'] is not None and old['memory'] is not None and
+                    new['memory'] > (1 + tolerance) * old['memory']):
+                regressions.append((key, stage, 'memory', new['memory'],
+                                    old['memory']))
+    return regressions
+
+
+###############################################################################
+# Clustering backends
+
+def _masker(mask):
+    import nibabel
+    from nilearn.input_data import NiftiMasker
+    mask_img = nibabel.Nifti1Image(mask.astype(np.int8), np.eye(4))
+    return NiftiMasker(mask_img=mask_img).fit()
+
+
+def _clustering_methods():
+    return [('ward', MyFeatureAgglomeration()),
+            ('renn_fast', ReNN(linkage='fast')),
+            ('renn_single', ReNN(linkage='single')),
+            ('renn_random_single', ReNN(linkage='random_single',
+                                        random_state=0))]
+
+
+def _parcel_stats(sizes):
+    return {'n_parcels': len(sizes), 'size_min': int(np.min(sizes)),
+            'size_median': float(np.median(sizes)),
+            'size_max': int(np.max(sizes)),
+            'n_singletons': int(np.sum(sizes == 1))}
+
+
+def _relative_error(X, X_compressed):
+    return float(np.sum((X - X_compressed) ** 2) / np.sum(X ** 2))
+
+
+def benchmark_clustering_case(mask_shape, cluster_ratio, n_samples=100,
+                              random_seed=1):
+    """Time and evaluate every clustering backend on one mask"""
+    mask = brain_mask(mask_shape)
+    X, _, _, _, _, _ = univariate_simulation(0, n_samples, mask_shape,
+                                             random_seed)
+    X = X[:, mask.ravel()]
+    n_clusters = max(2, int(cluster_ratio * mask.sum()))
+    masker = _masker(mask)
+    rows = []
+
+    for name, method in _clustering_methods():
+        (method, elapsed), _, memory = measure(
+            _fit_method, X, method, n_clusters, masker)
+        X_compressed = method.inverse_transform(method.transform(X))
+        row = {'method': name, 'time': elapsed, 'memory': memory,
+               'error': _relative_error(X, X_compressed)}
+        row.update(_parcel_stats(method.sizes_))
+        rows.append(row)
+
+    connectivity = get_mask_geometry(mask).connectivity
+    (P_inv, X_proj, labels), elapsed, memory = measure(
+        projection, X, n_clusters, connectivity, ward=False)
+    row = {'method': 'projection', 'time': elapsed, 'memory': memory,
+           'error': _relative_error(X, P_inv.dot(X_proj.T).T)}
+    row.update(_parcel_stats(np.bincount(labels)))
+    rows.append(row)
+
+    for row in rows:
+        row.update({'n_voxels': int(mask.sum()), 'n_clusters': n_clusters})
+    return rows
+
+
+def run_clustering_benchmarks(mask_shapes=MASK_SHAPES,
+                              cluster_ratios=CLUSTER_RATIOS, n_samples=100,
+                              output=None):
+    """Compare the clustering backends, and print the table"""
+    rows = []
+    for shape, ratio in itertools.product(mask_shapes, cluster_ratios):
+        rows.extend(benchmark_clustering_case(shape, ratio, n_samples))
+    print(format_table(rows))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(rows, f, indent=1, sort_keys=True)
+    return rows
+
+
+def run_threads_benchmarks(shape=THREADS_SHAPE, n_samples=300,
+                           n_jobs_list=N_JOBS, mean_size_clust=10,
+                           output=None):
+    """Time the threaded stages of the clustering, the edge weights and
+    the reduction of the data, for each n_jobs, and print the table"""
+    connectivity = get_mask_geometry(np.ones(shape, dtype=bool)).connectivity
+    edges, _ = _connectivity_to_edges(connectivity)
+    n_voxels = connectivity.shape[0]
+    X = np.random.RandomState(0).randn(n_samples, n_voxels)
+    labels = np.arange(n_voxels) // mean_size_clust
+    incidence = _random_incidence(labels, labels.max() + 1)
+    rows = []
+    for n_jobs in n_jobs_list:
+        for stage, func, args in [('edge_weights', _edge_weights, (edges,)),
+                                  ('reduce_data', _reduce_data,
+                                   (incidence,))]:
+            _, elapsed, memory = measure(func, X, *args, n_jobs=n_jobs)
+            rows.append({'stage': stage, 'n_jobs': n_jobs, 'time': elapsed,
+                         'memory': memory, 'n_voxels': n_voxels,
+                         'n_samples': n_samples})
+    print(format_table(rows, columns=['n_voxels', 'n_samples', 'stage',
+                                      'n_jobs', 'time', 'memory']))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(rows, f, indent=1, sort_keys=True)
+    return rows
+
+
+def format_table(rows, columns=None):
+    if columns is None:
+        columns = ['n_voxels', 'n_clusters', 'method', 'time', 'memory',
+                   'error', 'n_parcels', 'size_min', 'size_median',
+                   'size_max', 'n_singletons']
+    lines = [' '.join('%12s' % c[:12] for c in columns)]
+    for row in rows:
+        cells = []
+        for column in columns:
+            value = row[column]
+            if isinstance(value, float):
+                cells.append('%12.4g' % value)
+            else:
+                cells.append('%12s' % (value if value is not None else '-'))
+        lines.append(' '.join(cells))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'clustering':
+        run_clustering_benchmarks(
+            output=sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'threads':
+        run_threads_benchmarks(
+            output=sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
+    # run needs a results file, compare a results and a baseline file
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if len(sys.argv) != {'run': 3, 'compare': 4}.get(command):
+        print(__doc__)
+        sys.exit(2)
+    if sys.argv[1] == 'run':
+        run_benchmarks(output=sys.argv[2])
+    else:
+        with open(sys.argv[2]) as f:
+            report = json.load(f)
+        with open(sys.argv[3]) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline)
+        for key, stage, metric, new, old in regressions:
+            print('REGRESSION %s %s %s: %.3f (baseline %.3f)' % (
+                key, stage, metric, new, old))
+        sys.exit(1 if regressions else 0)
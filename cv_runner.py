@@ -0,0 +1,81 @@
+""" Parallel cross-validation and subsampling of an estimator
+
+Each fold fits its own copy of the estimator in a worker process. The
+data (and the array arguments of fit, such as the connectivity) are
+dumped once to a temporary folder and memory-mapped by the workers, so
+that they are shared instead of being copied to every process.
+"""
+
+import os
+import shutil
+import tempfile
+from copy import deepcopy
+
+import numpy as np
+from joblib import Parallel, delayed, dump, load
+
+
+def _share(value, folder, name):
+    """value memory-mapped from a dump in folder, if it is an array"""
+    if not (isinstance(value, np.ndarray) or hasattr(value, 'tocsr')):
+        return value
+    filename = os.path.join(folder, '%s.pkl' % name)
+    dump(value, filename)
+    return load(filename, mmap_mode='r')
+
+
+def _fit_fold(estimator, X, y, train, test, fit_params, scorer):
+    """Fit a copy of estimator on train, and score it on test"""
+    estimator = deepcopy(estimator)
+    estimator.fit(X[train], y[train], **fit_params)
+    score = None
+    if scorer is not None and test is not None:
+        score = scorer(estimator, X[test], y[test])
+    return score, estimator.coef_
+
+
+def run_folds(estimator, X, y, folds, fit_params=None, scorer=None,
+              n_jobs=1, temp_folder=None):
+    """Fit estimator on the train set of each fold, in parallel
+
+    estimator : estimator
+        Copied for each fold, with deepcopy: every fold starts from its
+        state (e.g. its random generator), whatever the order of the folds
+
+    X : np.float((n, p))
+        The data, memory-mapped by the workers
+
+    folds : iterable of (train, test)
+        Indices of the folds, e.g. a cross-validation iterator. test may be
+        None for subsampling, where only the coefficients are needed.
+
+    fit_params : dict, optional
+        Extra arguments of fit. Arrays and sparse matrices are
+        memory-mapped by the workers as well.
+
+    scorer : callable, optional
+        scorer(estimator, X_test, y_test) gives the score of a fold
+
+    temp_folder : string, optional
+        Where the shared data are dumped, by default a new temporary folder
+
+    Returns the scores (None if there is no scorer or no test set) and the
+    coefficients, np.float((n_folds, p)), in the order of the folds.
+    """
+    folds = list(folds)
+    fit_params = fit_params or {}
+    folder = tempfile.mkdtemp(prefix='cv_runner_', dir=temp_folder)
+    try:
+        if n_jobs != 1:
+            X = _share(X, folder, 'X')
+            fit_params = dict((name, _share(value, folder, name))
+                              for name, value in fit_params.items())
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_fold)(estimator, X, y, train, test, fit_params,
+                               scorer)
+            for train, test in folds)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    scores = [score for score, _ in results]
+    coefs = np.array([coef for _, coef in results])
+    return scores, coefs
@@ -7,136 +7,213 @@ Author: Bertrand Thirion, Gael Varoquaux, Andres Hoyos idrobo, 2014
 
 import warnings
 import numpy as np
-from joblib import Parallel, delayed, Memory
+from joblib import Parallel, delayed, Memory, cpu_count
 from scipy.sparse import csgraph, coo_matrix, dia_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
 from sklearn.base import BaseEstimator
 from sklearn import clone
-from nilearn.input_data import NiftiMasker
-from sklearn.utils import check_array
-from base_clustering import ClusteringTransformer
+from sklearn.utils import check_array, check_random_state
+from base_clustering import (ClusteringTransformer, sketch_samples,
+                             _check_data, _chunk_size)
+from mask_geometry import get_mask_geometry
+
+
+def _n_threads(n_jobs):
+    """ Number of threads corresponding to joblib's n_jobs (None is 1)"""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+# memory, in bytes, of the two (n_edges, n_samples) temporaries of a chunk
+# of samples in _edge_weights
+EDGE_WEIGHTS_BUDGET = 2 ** 28
+
+
+def _squared_diff_sum(chunk_t, edges):
+    """ Sum over the samples of the squared differences along the edges
+
+    chunk_t is voxel-major, (n_voxels, n_samples), so that the gathers
+    along the edges read contiguous rows.
+    """
+    diff = chunk_t[edges[0]]
+    diff -= chunk_t[edges[1]]
+    return np.einsum('ij,ij->i', diff, diff)
 
-import matplotlib.pyplot as plt
 
 #@profile
-def _compute_weights(nifti_masker, data):
-    """Compute the weights corresponding to all edges in the mask"""
-    fmri = nifti_masker.inverse_transform(data).get_data()
-    weight_deep = np.sum(np.diff(fmri, axis=2) ** 2, axis=-1)
-    weight_right = np.sum(np.diff(fmri, axis=1) ** 2, axis=-1)
-    weight_down = np.sum(np.diff(fmri, axis=0) ** 2, axis=-1)
-
-    weight = np.hstack((weight_deep.ravel(),
-                        weight_right.ravel(),
-                        weight_down.ravel()))
-
-    return weight
-
-
-def _create_ordered_edges(nifti_masker, data):
-    """ Create the edges set, the correspoding weight,
-    and order them by increasing values"""
-    # Compute connectivity matrix: which voxel is connected to which
-    mask = nifti_masker.mask_img_.get_data()
-    n_x, n_y, n_z = mask.shape
-    n_voxels = n_x * n_y * n_z
-
-    # The indices of the edges
-    vertices = np.arange(n_voxels).reshape((n_x, n_y, n_z))
-
-    edges_deep = np.vstack((vertices[:, :, :-1].ravel(),
-                            vertices[:, :, 1:].ravel()))
-    edges_right = np.vstack((vertices[:, :-1].ravel(),
-                             vertices[:, 1:].ravel()))
-    edges_down = np.vstack((vertices[:-1].ravel(), vertices[1:].ravel()))
-    edges = np.hstack((edges_deep, edges_right, edges_down))
-
-    # Masking
-    edges_deep_mask = np.logical_and(mask[:, :, :-1].ravel(),
-                                     mask[:, :, 1:].ravel())
-    edges_right_mask = np.logical_and(mask[:, :-1].ravel(),
-                                      mask[:, 1:].ravel())
-    edges_down_mask = np.logical_and(mask[:-1].ravel(), mask[1:].ravel())
-    edges_mask = np.hstack((edges_deep_mask, edges_right_mask,
-                            edges_down_mask))
-
-    # Image-level operation to compute weights on the edges
-    weight = _compute_weights(nifti_masker, data)
-
-    # Apply the mask
-    weight = weight[edges_mask]
-    edges = edges[:, edges_mask]
-
-    # Reorder the indices of the graph
-    max_index = edges.max()
-    order = np.searchsorted(np.unique(edges.ravel()), np.arange(max_index + 1))
-    edges = order[edges]
-
-    return edges, weight, edges_mask
-
-
-
-def _fast_nn_connectivity(connectivity, return_weight=False, thr=1.):
-    """ Reduce the connectivity to nearest neighbor connectivity"""
-    n_voxels = connectivity.shape[0]
-    connectivity_ = coo_matrix(
-        (1. / connectivity.data, connectivity.nonzero()),
-        (n_voxels, n_voxels)).tocsr()
-    inv_max = dia_matrix((1. / connectivity_.max(axis=0).toarray()[0], 0),
-                         shape=(n_voxels, n_voxels))
-    connectivity_ = inv_max * connectivity_
-    edge_mask = connectivity_.data > thr - 1.e-7
-    j_idx = connectivity_.nonzero()[1][edge_mask]
-    i_idx = connectivity_.nonzero()[0][edge_mask]
-
-    if return_weight:
-        weight = connectivity.data[edge_mask]
+def _edge_weights(data, edges, n_jobs=1):
+    """ Squared euclidean distance between the columns of data linked by
+    the edges
+
+    data is read by chunks of samples, so that it can be a np.memmap, and
+    the sums are accumulated in float32: the memory is proportional to the
+    number of edges. The chunks are as large as EDGE_WEIGHTS_BUDGET allows,
+    since small ones make the gathers along the edges slow. With
+    n_jobs > 1, the edges of each chunk are split in one block per thread
+    (NumPy releases the GIL), and the same thread pool serves all the
+    chunks. See benchmarks.py threads for the scaling.
+    """
+    n_samples, n_voxels = data.shape
+    n_edges = edges.shape[1]
+    n_threads = _n_threads(n_jobs)
+    bounds = np.linspace(0, n_edges, n_threads + 1).astype(int)
+    edges_slices = [edges[:, start:stop]
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    weight = np.zeros(n_edges, dtype=np.float32)
+    itemsize = np.dtype(data.dtype).itemsize
+    chunk_size = max(1, EDGE_WEIGHTS_BUDGET // (2 * n_edges * itemsize))
+    with Parallel(n_jobs=n_threads, backend='threading') as parallel:
+        for start in range(0, n_samples, chunk_size):
+            chunk_t = np.ascontiguousarray(np.asarray(
+                data[start:start + chunk_size]).T)
+            if n_threads == 1:
+                weight += _squared_diff_sum(chunk_t, edges)
+            else:
+                weight += np.hstack(parallel(
+                    delayed(_squared_diff_sum)(chunk_t, edges_slice)
+                    for edges_slice in edges_slices))
+    return np.maximum(1.e-6, weight)
+
+
+def _reduce_data(data, incidence, n_jobs=1):
+    """ Reduced data (incidence * data.T).T, over chunks of samples
+
+    Only one chunk of data per thread is loaded at a time, so that data can
+    be a np.memmap. With n_jobs > 1, the samples are split in one block per
+    thread, unless the blocks would exceed the memory of a chunk.
+    """
+    n_samples, n_voxels = data.shape
+    n_threads = _n_threads(n_jobs)
+    chunk_size = min(_chunk_size(n_voxels), -(- n_samples // n_threads))
+    starts = range(0, n_samples, chunk_size)
+    if n_threads == 1:
+        r_data = [_reduce_chunk(data[start:start + chunk_size], incidence)
+                  for start in starts]
     else:
-        weight = np.ones_like(j_idx)
+        r_data = Parallel(n_jobs=n_threads, backend='threading')(
+            delayed(_reduce_chunk)(data[start:start + chunk_size], incidence)
+            for start in starts)
+    return np.vstack(r_data)
 
-    edges = np.array((i_idx, j_idx))
-    nn_connectivity = coo_matrix(
-        (weight, edges), (n_voxels, n_voxels))
 
-    return nn_connectivity
+def _reduce_chunk(chunk, incidence):
+    return (incidence * np.asarray(chunk).T).T
 
 
-def _nn_cluster_and_reduce(connectivity, data, n_clusters=None, random=False):
-    """ Cluster according to nn and reduce the data and connectivity"""
+def _create_ordered_edges(nifti_masker, data, n_jobs=1):
+    """ Create the edges set of the mask, in the masked voxels space, and
+    the corresponding weights"""
+    edges = get_mask_geometry(nifti_masker.mask_img_.get_data()).edges
+    weight = _edge_weights(data, edges, n_jobs=n_jobs)
+    return edges, weight
+
+
+def _unique_edges(i_idx, j_idx, n_nodes):
+    """ Canonical set of undirected edges, without self-loops
+
+    Returns the (2, n_edges) int32 array of edges (i < j), sorted, and the
+    index of the input pair each of them comes from.
+    """
+    keep = np.flatnonzero(i_idx != j_idx)
+    i_idx, j_idx = i_idx[keep], j_idx[keep]
+    low = np.minimum(i_idx, j_idx).astype(np.int64)
+    high = np.maximum(i_idx, j_idx).astype(np.int64)
+    key, index = np.unique(low * n_nodes + high, return_index=True)
+    edges = np.vstack((key // n_nodes, key % n_nodes)).astype(np.int32)
+    return edges, keep[index]
+
+
+def _connectivity_to_edges(connectivity):
+    """ Edge list and weights of a sparse connectivity matrix"""
+    connectivity = coo_matrix(connectivity)
+    edges, index = _unique_edges(connectivity.row, connectivity.col,
+                                 connectivity.shape[0])
+    return edges, connectivity.data[index]
+
+
+def _union_find(n_nodes, edges):
+    """ Vectorized union-find: label of the connected component of each node
+
+    The roots are hooked onto the smallest root they are linked to, and the
+    trees are flattened by pointer jumping, until all edges are internal.
+    """
+    parent = np.arange(n_nodes)
+    i_idx, j_idx = edges
+    while True:
+        root_i, root_j = parent[i_idx], parent[j_idx]
+        cross = root_i != root_j
+        if not cross.any():
+            break
+        low = np.minimum(root_i[cross], root_j[cross])
+        high = np.maximum(root_i[cross], root_j[cross])
+        # for each root, the smallest root it is linked to
+        order = np.lexsort((low, high))
+        high, low = high[order], low[order]
+        first = np.ones(len(high), dtype=bool)
+        first[1:] = high[1:] != high[:-1]
+        parent[high[first]] = low[first]
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                break
+            parent = grand_parent
+    labels_name, labels = np.unique(parent, return_inverse=True)
+    return len(labels_name), labels.astype(np.int32)
+
+
+def _nn_edges(edges, weight, n_nodes):
+    """ Indices of the edges that link each node to its nearest neighbor
+
+    Ties are broken by edge index, so that the selected edges form a forest.
+    The result is sorted by increasing weight.
+    """
+    n_edges = edges.shape[1]
+    # rank of each edge by increasing weight, then index (the sort is
+    # stable): the nearest neighbor edge of a node has the smallest rank
+    order = np.argsort(weight, kind='mergesort')
+    rank = np.empty(n_edges, dtype=np.int64)
+    rank[order] = np.arange(n_edges)
+    # the edges grouped by node, in linear time, for a per-node minimum
+    adjacency = coo_matrix(
+        (np.tile(rank + 1, 2), (np.hstack((edges[0], edges[1])),
+                                np.hstack((edges[1], edges[0])))),
+        shape=(n_nodes, n_nodes)).tocsr()
+    degree = np.diff(adjacency.indptr)
+    nn_rank = np.minimum.reduceat(adjacency.data,
+                                  adjacency.indptr[:-1][degree > 0]) - 1
+    selected = np.zeros(n_edges, dtype=bool)
+    selected[nn_rank] = True
+    return order[selected]
+
+
+def _nn_cluster_and_reduce(edges, weight, data, n_clusters=None,
+                           random=False, n_jobs=1):
+    """ Cluster according to nn and reduce the data and the graph
+
+    Also returns the merged edges, in increasing weight order.
+    """
     if n_clusters == None:
         n_clusters = 1
-    nn_connectivity = _fast_nn_connectivity(connectivity)
-    n_voxels = connectivity.shape[0]
-    n_labels = n_voxels - (nn_connectivity + nn_connectivity.T).nnz / 2
-
-    if n_labels < n_clusters:
-        # cut some links to achieve the desired number of clusters
-        alpha = n_voxels - n_clusters
-        nn_connectivity = nn_connectivity + nn_connectivity.T
-        edges_ = np.array(nn_connectivity.nonzero())
-        plop = edges_[0] - edges_[1]
-        select = np.argsort(plop)[:alpha]
-
-        nn_connectivity = coo_matrix(
-            (np.ones(2 * alpha),
-             np.hstack((edges_[:, select], edges_[::-1, select]))),
-            (n_voxels, n_voxels))
+    n_voxels = data.shape[1]
+    nn_index = _nn_edges(edges, weight, n_voxels)
+
+    # each nn edge of the forest merges two clusters: keep the lightest ones
+    # to achieve the desired number of clusters
+    merges = edges[:, nn_index[:max(0, n_voxels - n_clusters)]]
 
     # clustering
-    n_labels, labels = csgraph.connected_components(nn_connectivity)
+    n_labels, labels = _union_find(n_voxels, merges)
     incidence = _random_incidence(labels, n_labels, random)
 
-    # reduced data
-    r_data = (incidence * data.T).T
-    r_connectivity = (incidence * connectivity) * incidence.T
-    r_connectivity = r_connectivity - dia_matrix(
-        (r_connectivity.diagonal(), 0), shape=(r_connectivity.shape))
-    i_idx, j_idx = r_connectivity.nonzero()
-    data_ = np.maximum(1.e-6, np.sum(
-        (r_data[:, i_idx] - r_data[:, j_idx]) ** 2, 0))
-    r_connectivity.data = data_
-    assert (r_connectivity.data > 0).all()
-    return r_connectivity, r_data, labels
+    # reduced data and graph
+    r_data = _reduce_data(data, incidence, n_jobs=n_jobs)
+    r_edges, _ = _unique_edges(labels[edges[0]], labels[edges[1]], n_labels)
+    r_weight = _edge_weights(r_data, r_edges, n_jobs=n_jobs)
+    return r_edges, r_weight, r_data, labels, merges
 
 
 def _random_incidence(labels, n_labels, random=False):
@@ -156,100 +233,223 @@ def _random_incidence(labels, n_labels, random=False):
     return inv_sum_col * incidence
 
 
-def recursive_nn(connectivity, data, n_clusters=None, n_iter=10, random=False):
-    labels = np.arange(connectivity.shape[0])
+def _recursive_nn(edges, weight, data, n_clusters=None, n_iter=10,
+                  random=False, return_hierarchy=False, n_jobs=1):
+    """ Recursive nearest neighbor clustering of an edge-list graph"""
+    n_labels = data.shape[1]
+    labels = np.arange(n_labels, dtype=np.int32)
+    hierarchy = []
 
     if n_clusters == None:
         n_clusters = 1
-    n_labels = connectivity.shape[0]
 
     for i in range(n_iter):
-        connectivity, data, r_labels = _nn_cluster_and_reduce(
-            connectivity, data, n_clusters, random)
+        edges, weight, data, r_labels, merges = _nn_cluster_and_reduce(
+            edges, weight, data, n_clusters, random, n_jobs)
         labels = r_labels[labels]
-        n_labels = connectivity.shape[0]
+        if return_hierarchy:
+            hierarchy.append((r_labels, merges))
+        n_labels, previous_n_labels = data.shape[1], n_labels
 
-        if n_labels <= n_clusters:
+        if n_labels <= n_clusters or n_labels == previous_n_labels:
             break
 
-    return connectivity.shape[0], labels
+    if return_hierarchy:
+        return n_labels, labels, hierarchy
+    return n_labels, labels
 
 
-def fast_cluster_nopercol(nifti_masker, data, n_clusters=500, random=False):
-    """Attempts to implement a method that avoids percolation"""
-    n_voxels = nifti_masker.mask_img_.get_data().sum()
+def recursive_nn(connectivity, data, n_clusters=None, n_iter=10, random=False,
+                 return_hierarchy=False, n_jobs=1):
+    """ Recursive nearest neighbor clustering
+
+    connectivity : sparse matrix (p, p)
+        The graph of the voxels. Its values are the weights of the edges
+        used for the first nearest neighbor step.
+
+    data : np.float((n, p))
+        The data. After the first step, the edges are weighted by the
+        squared distance between the reduced data.
+
+    return_hierarchy : bool, optional
+        If True, the list of the levels is returned as well. Each level is
+        a pair (labels, merges): the labels of the nodes of the previous
+        level, and the (2, n_merges) array of the nearest neighbor edges
+        merged at this level, by increasing weight. See cut_hierarchy.
+
+    n_jobs : int, optional
+        Number of threads used for the reduction of the data and the
+        distances between the reduced data
+    """
+    edges, weight = _connectivity_to_edges(connectivity)
+    return _recursive_nn(edges, weight, data, n_clusters=n_clusters,
+                         n_iter=n_iter, random=random,
+                         return_hierarchy=return_hierarchy, n_jobs=n_jobs)
 
-    edges, weight, edges_mask = _create_ordered_edges(
-        nifti_masker, data)
 
-    connectivity = coo_matrix(
-        (weight, edges), (n_voxels, n_voxels)).tocsr()
-    connectivity = (connectivity + connectivity.T)
+def cut_hierarchy(hierarchy, n_clusters):
+    """ Labels for n_clusters clusters from a recursive_nn hierarchy
 
-    n_labels, labels = recursive_nn(connectivity, data, n_clusters=n_clusters,
-                                    random=random)
+    The deepest level with at least n_clusters clusters is selected, and
+    refined with the lightest merges of the next level. For a hierarchy
+    computed down to one cluster, this gives the same labels as running
+    recursive_nn with n_clusters (without randomization).
+    """
+    n_labels = len(hierarchy[0][0])
+    labels = np.arange(n_labels, dtype=np.int32)
+    for level_labels, merges in hierarchy:
+        if n_labels <= n_clusters:
+            break
+        if n_labels - merges.shape[1] < n_clusters:
+            # each merge of the forest removes exactly one cluster
+            _, level_labels = _union_find(
+                n_labels, merges[:, :n_labels - n_clusters])
+        labels = level_labels[labels]
+        n_labels = level_labels.max() + 1
     return n_labels, labels
 
-#@profile
-def single_linkage(nifti_masker, data, n_clusters):
-    """Single linkage clustering"""
-    n_voxels = nifti_masker.mask_img_.get_data().sum()
-    edges, weight, edges_mask = _create_ordered_edges(
-        nifti_masker, data)
-    connectivity = coo_matrix(
-        (weight, edges), (n_voxels, n_voxels))
-    connectivity = connectivity + connectivity.T
 
-    mst = minimum_spanning_tree(connectivity)
-    weight = mst.data
-    mst.data = np.ones_like(mst.data)
-    edges = np.array(mst.nonzero())
+def fast_cluster_nopercol(nifti_masker, data, n_clusters=500, random=False,
+                          return_hierarchy=False, n_jobs=1):
+    """Attempts to implement a method that avoids percolation"""
+    edges, weight = _create_ordered_edges(nifti_masker, data, n_jobs=n_jobs)
 
-    index = np.argsort(weight)
-    edges = edges[:, index[:-n_clusters]]
-    weight = np.ones_like(index[:-n_clusters])
+    return _recursive_nn(edges, weight, data,
+                         n_clusters=n_clusters, random=random,
+                         return_hierarchy=return_hierarchy, n_jobs=n_jobs)
 
-    mst = coo_matrix((weight, edges), (n_voxels, n_voxels))
+class SingleLinkageTree(object):
+    """Minimum spanning tree of a graph, with edges sorted by weight
 
-    n_labels, labels = csgraph.connected_components(mst)
-    # print n_clusters, n_labels
+    The single linkage clustering with k clusters is given by the
+    connected components of the n_voxels - k lightest edges of the tree,
+    so that the tree is computed once for any number of clusters.
+    """
 
-    return n_labels, labels
+    def __init__(self, edges, weight, n_voxels):
+        # zero weights would be dropped by minimum_spanning_tree
+        connectivity = coo_matrix(
+            (np.maximum(weight, 1.e-12), edges), (n_voxels, n_voxels))
+        mst = minimum_spanning_tree(connectivity).tocoo()
+        order = np.argsort(mst.data, kind='mergesort')
+        self.edges = np.vstack((mst.row, mst.col))[:, order].astype(np.int32)
+        self.weight = mst.data[order]
+        self.n_voxels = n_voxels
 
+    def labels(self, n_clusters):
+        """Single linkage (n_labels, labels) for n_clusters clusters
+
+        If n_clusters is a sequence, a list of results is returned.
+        """
+        if np.ndim(n_clusters) > 0:
+            return [self.labels(k) for k in n_clusters]
+        n_edges = max(0, self.n_voxels - n_clusters)
+        return _union_find(self.n_voxels, self.edges[:, :n_edges])
+
+    def random_labels(self, n_clusters, n_parcellations=1, random_state=None,
+                      n_iter=4):
+        """Random parcellations obtained by cutting random edges of the tree
+
+        As in the original random single linkage, the edges are cut in
+        n_iter rounds, and the edges that link a leaf of the remaining
+        forest, recomputed at each round, are not cut, so as to avoid
+        singletons. The cuts of a round that would still isolate a node
+        (e.g. both edges of a node of degree 2) are undone, and made up for
+        in the next rounds. All the parcellations are cut at once, on
+        n_parcellations copies of the tree.
+
+        If the forest can not be cut further without singletons, the last
+        cuts are random edges, which may isolate nodes, so that every
+        parcellation has exactly n_clusters labels (at most p).
+
+        Returns an int32 array of labels of shape (n_parcellations, p).
+        """
+        rng = check_random_state(random_state)
+        n_voxels, edges = self.n_voxels, self.edges
+        n_edges = edges.shape[1]
+        rows = np.arange(n_parcellations)[:, np.newaxis]
+        # the endpoints of the edges of each copy of the tree
+        ends = edges[:, np.newaxis, :] + rows.astype(np.int64) * n_voxels
+
+        def end_degrees(keep):
+            """Degrees, in the kept forest, of the endpoints of the edges"""
+            degree = np.bincount(ends[:, keep].ravel(),
+                                 minlength=n_parcellations * n_voxels)
+            return degree[ends]
+
+        keep = np.ones((n_parcellations, n_edges), dtype=bool)
+        remaining = np.repeat(
+            min(n_edges, max(0, n_clusters - (n_voxels - n_edges))),
+            n_parcellations)
+        # after a round where all its cuts are undone, the edges of a
+        # parcellation are cut one at a time, which never isolates a node
+        one_by_one = np.zeros(n_parcellations, dtype=bool)
+        i = 0
+        while remaining.any():
+            candidates = keep & (end_degrees(keep) > 1).all(axis=0)
+            n_round = -(-remaining // max(1, n_iter - i))
+            n_round[one_by_one] = np.minimum(1, n_round[one_by_one])
+            n_round = np.minimum(n_round, candidates.sum(axis=1))
+            if not n_round.any():
+                break
+            priority = np.where(candidates, rng.rand(*keep.shape), 2.)
+            rank = np.argsort(np.argsort(priority, axis=1), axis=1)
+            cut = rank < n_round[:, np.newaxis]
+            cut &= (end_degrees(keep & ~cut) > 0).all(axis=0)
+            keep &= ~cut
+            n_done = cut.sum(axis=1)
+            one_by_one |= (n_done == 0) & (n_round > 0)
+            remaining -= n_done
+            i += 1
+        if remaining.any():
+            priority = np.where(keep, rng.rand(*keep.shape), 2.)
+            rank = np.argsort(np.argsort(priority, axis=1), axis=1)
+            keep &= rank >= remaining[:, np.newaxis]
+
+        parcellation, edge_index = np.nonzero(keep)
+        _, labels = _union_find(n_parcellations * n_voxels,
+                                ends[:, parcellation, edge_index])
+        labels = labels.reshape(n_parcellations, n_voxels)
+        # the components of each copy have consecutive labels
+        labels -= labels.min(axis=1)[:, np.newaxis]
+        return labels
+
+
+def single_linkage_tree(nifti_masker, data, n_jobs=1):
+    """Sorted minimum spanning tree for single linkage clustering"""
+    edges, weight = _create_ordered_edges(nifti_masker, data, n_jobs=n_jobs)
+    return SingleLinkageTree(edges, weight, data.shape[1])
 
-def random_single_linkage(nifti_masker, data, n_clusters):
-    """Single linkage clustering with random selection"""
-    n_voxels = nifti_masker.mask_img_.get_data().sum()
-    edges, weight, edges_mask = _create_ordered_edges(
-        nifti_masker, data)
-    connectivity = coo_matrix(
-        (weight, edges), (n_voxels, n_voxels))
-    # connectivity = connectivity + connectivity.T
-
-    mst = minimum_spanning_tree(connectivity)
-    mst.data = np.ones_like(mst.data)
-    edges, weight = np.array(mst.nonzero()), mst.data
-
-    # do not select terminal nodes
-    n_iter = 4
-    for i in range(n_iter):
-        singletons = np.asarray((mst + mst.T).sum(axis=0) == 1).ravel()
 
-        edges_mask = singletons[edges].max(axis=0) > 0
-        select = np.hstack((
-                np.ones(len(weight) - edges_mask.sum() - n_clusters / n_iter),
-                np.zeros(n_clusters / n_iter))).astype(np.bool)
-        np.random.shuffle(select)
-        edges_mask[edges_mask == 0] = select
-        edges, weight = edges[:, edges_mask], np.ones(edges_mask.sum())
-        mst = coo_matrix((weight, edges), (n_voxels, n_voxels))
+#@profile
+def single_linkage(nifti_masker, data, n_clusters, n_jobs=1):
+    """Single linkage clustering"""
+    return single_linkage_tree(nifti_masker, data, n_jobs).labels(n_clusters)
 
-    n_labels, labels = csgraph.connected_components(mst)
 
-    return n_labels, labels
+def random_single_linkage(nifti_masker, data, n_clusters, random_state=None,
+                          n_jobs=1):
+    """Single linkage clustering with random selection"""
+    labels = single_linkage_tree(nifti_masker, data, n_jobs).random_labels(
+        n_clusters, random_state=random_state)[0]
+    return labels.max() + 1, labels
 
 
+def random_parcellations(connectivity, data, n_clusters, n_parcellations,
+                         random_state=None, n_jobs=1):
+    """Bank of random single linkage parcellations
 
+    The minimum spanning tree of the connectivity, weighted by the squared
+    distances between the columns of data, is computed once.
+    Returns an int32 array of labels of shape (n_parcellations, p), with
+    exactly n_clusters labels each, e.g. one parcellation per split of
+    StabilityLasso.fit (parcellations).
+    """
+    edges, _ = _connectivity_to_edges(connectivity)
+    weight = _edge_weights(data, edges, n_jobs=n_jobs)
+    tree = SingleLinkageTree(edges, weight, data.shape[1])
+    return tree.random_labels(n_clusters, n_parcellations,
+                              random_state=random_state)
 
 
 class ReNN(BaseEstimator, ClusteringTransformer):
@@ -260,7 +460,8 @@ class ReNN(BaseEstimator, ClusteringTransformer):
                  standardize=True, smoothing_fwhm=None, target_affine=None,
                  target_shape=None, mask_strategy='epi', memory=None,
                  memory_level=0, verbose=0, n_jobs=1, random=False,
-                 scaling=False):
+                 scaling=False, n_sketch=None, sketch='gaussian',
+                 random_state=None, compute_full_tree=False):
 
         self.scaling = scaling
         self.linkage = linkage
@@ -276,115 +477,112 @@ class ReNN(BaseEstimator, ClusteringTransformer):
         self.verbose = verbose
         self.n_jobs = n_jobs
         self.random = random
+        self.n_sketch = n_sketch
+        self.sketch = sketch
+        self.random_state = random_state
+        self.compute_full_tree = compute_full_tree
 
     def fit(self, X, y=None):
         """
+        X : np.float((n, p)), np.memmap or array-like of shape (n, p)
+            The data. A memmap or another sliceable source (e.g. an h5py
+            dataset) is read by chunks of samples, and never fully loaded.
         """
-        X = check_array(X, accept_sparse=['csr', 'csc', 'coo'],
-                        ensure_min_features=2, estimator=self)
+        X = _check_data(X, estimator=self)
 
         self.memory_ = Memory(cachedir=self.memory, verbose=self.verbose)
 
-        if self.linkage == 'fast':
+        # the clustering only needs distances between voxels, which are
+        # approximately preserved by a random projection of the samples
+        X_clust = sketch_samples(X, self.n_sketch, sketch=self.sketch,
+                                 random_state=self.random_state)
+
+        # forget the tree of a previous fit
+        for attr in ('tree_', 'hierarchy_'):
+            self.__dict__.pop(attr, None)
+
+        if self.linkage == 'fast' and self.compute_full_tree:
+            # cluster down to a single cluster, and keep all the levels
+            _, _, self.hierarchy_ = fast_cluster_nopercol(
+                self.masker, X_clust, n_clusters=1, random=self.random,
+                return_hierarchy=True, n_jobs=self.n_jobs)
+            n_labels, labels = cut_hierarchy(self.hierarchy_, self.n_clusters)
+
+        elif self.linkage == 'fast':
             n_labels, labels = fast_cluster_nopercol(
-                self.masker, X, n_clusters=self.n_clusters, random=self.random)
+                self.masker, X_clust, n_clusters=self.n_clusters,
+                random=self.random, n_jobs=self.n_jobs)
 
         elif self.linkage == 'random_single':
-            n_labels, labels = random_single_linkage(self.masker, X,
-                                                     n_clusters=self.n_clusters)
+            n_labels, labels = random_single_linkage(
+                self.masker, X_clust, n_clusters=self.n_clusters,
+                random_state=self.random_state, n_jobs=self.n_jobs)
 
         elif self.linkage == 'single':
-            n_labels, labels = single_linkage(self.masker, X,
-                                              n_clusters=self.n_clusters)
+            self.tree_ = single_linkage_tree(self.masker, X_clust,
+                                             n_jobs=self.n_jobs)
+            n_labels, labels = self.tree_.labels(self.n_clusters)
         self.n_labels_ = n_labels
         self.labels_ = labels
         self._check_labels_and_sizes()
 
         return self
 
+    def cut(self, n_clusters):
+        """Labels for n_clusters clusters, without clustering again
 
-
-
-### XXX Deprecated functions ###################################################
-# Used only for visualization of the method
-from base_clustering import _check_parcelation_results
-
-def fmri_reduction(data, labels, return_mat=False):
-    """Fast cluster-based reduction of data array """
-    n_voxels = data.shape[-1]
-    n_parcels = len(np.unique(labels))
-
-    parcellation_masks = coo_matrix(
-        (np.ones(n_voxels), (labels, np.arange(n_voxels))),
-        shape=(n_parcels, n_voxels),
-        dtype=np.float32).tocsc()
-
-    inv_sum_col = dia_matrix(
-        (np.array(1. / parcellation_masks.sum(1)).squeeze(), 0),
-        shape=(n_parcels, n_parcels))
-
-    parcellation_masks = inv_sum_col * parcellation_masks
-    fmri_reduced = parcellation_masks * data.T
-    if return_mat:
-        return fmri_reduced.T, parcellation_masks
-    return fmri_reduced.T
-
-
-def fmri_compression(data, labels, n_clusters):
-    """Fast cluster-based compression of data array"""
-    labels = _check_parcelation_results(labels, n_clusters)
-    fmri_reduced = fmri_reduction(data, labels)
-    fmri_compressed = np.array(fmri_reduced.T[labels])
-    return fmri_compressed
-
-
-import matplotlib.pyplot as plt
-from nilearn.plotting import plot_stat_map, plot_roi, plot_epi
-from nilearn import datasets
-from nilearn.input_data import NiftiMasker
-
-if __name__ == '__main__':
-
-    plt.close('all')
-
-    data_dir = '/volatile/andres/brain_codes/DATA/nilearn_data'
-    data_dir = None
-    dataset = datasets.fetch_haxby(data_dir=data_dir, n_subjects=1)
-
-    masker = NiftiMasker(mask_strategy='epi', smoothing_fwhm=6, memory='cache')
-    X = masker.fit_transform(dataset.func[0])
-
-    # cluster = KMeans(n_clusters=5)
-    cluster = ReNN(masker=masker, scaling=False, n_clusters=2000,
-                   linkage='fast',
-                             # linkage='single',
-                             # random=True,
-                             )
-
-    # # Test random projection
-    # random_projection = SRandomProjections(n_clusters=100)
-    # Xred = random_projection.fit_transform(X)
-
-    Xred = cluster.fit_transform(X[0: 10])
-    Xcomp = cluster.inverse_transform(Xred)
-
-    cut_coords = (10, -10, 0)
-
-    plot_epi(masker.inverse_transform(Xcomp[0]), title='compressed',
-             display_mode='ortho', cut_coords=cut_coords)
-    plot_epi(masker.inverse_transform(X[0]), title='original',
-             display_mode='ortho', cut_coords=cut_coords)
-
-     # Shuffle the labels (for better visualization):
-    labels = cluster.labels_
-    permutation = np.random.permutation(labels.shape[0])
-    labels = permutation[labels]
-    labels_img_ = masker.inverse_transform(labels)
-
-    plot_stat_map(labels_img_, bg_img=dataset.anat[0], title='clusters',
-                  display_mode='ortho', cut_coords=cut_coords, colorbar=False)
-    plt.show()
-
-    np.testing.assert_almost_equal(Xred[0], cluster.transform(Xcomp)[0])
-
-
+        Requires a fit with linkage='single', or with linkage='fast' and
+        compute_full_tree=True. If n_clusters is a sequence, a list of
+        label arrays is returned, one per number of clusters.
+        """
+        if np.ndim(n_clusters) > 0:
+            return [self.cut(k) for k in n_clusters]
+        if hasattr(self, 'tree_'):
+            _, labels = self.tree_.labels(n_clusters)
+        elif hasattr(self, 'hierarchy_'):
+            _, labels = cut_hierarchy(self.hierarchy_, n_clusters)
+        else:
+            raise ValueError("The hierarchy is not available: fit with "
+                             "linkage='single', or with linkage='fast' and "
+                             "compute_full_tree=True")
+        return labels
+
+
+def _baseline_random_cut(tree, n_clusters, rng, n_iter=4):
+    """Labels of the original random single linkage: n_clusters / n_iter
+    random edges cut per round, none linking a leaf of the remaining
+    forest"""
+    edges = tree.edges
+    for i in range(n_iter):
+        degree = np.bincount(edges.ravel(), minlength=tree.n_voxels)
+        leaf_edge = (degree[edges] == 1).any(axis=0)
+        select = np.ones((~leaf_edge).sum(), dtype=bool)
+        select[:n_clusters // n_iter] = False
+        rng.shuffle(select)
+        leaf_edge[~leaf_edge] = select
+        edges = edges[:, leaf_edge]
+    return _union_find(tree.n_voxels, edges)[1]
+
+
+def test_random_labels_singletons(shape=(8, 8, 8), n_seeds=10):
+    """Random single linkage must not make more singletons than the
+    original implementation"""
+    from sklearn.feature_extraction.image import grid_to_graph
+    edges, _ = _connectivity_to_edges(grid_to_graph(*shape))
+    n_voxels = int(np.prod(shape))
+    for n_clusters in (50, 100):
+        for seed in range(n_seeds):
+            rng = np.random.RandomState(seed)
+            tree = SingleLinkageTree(edges, rng.rand(edges.shape[1]),
+                                     n_voxels)
+            labels = tree.random_labels(n_clusters, random_state=seed)[0]
+            baseline = _baseline_random_cut(tree, n_clusters, rng)
+            n_singletons = np.sum(np.bincount(labels) == 1)
+            assert n_singletons <= np.sum(np.bincount(baseline) == 1)
+            assert n_singletons == 0
+            assert labels.max() + 1 == n_clusters
+    # a path can not be cut in 15 clusters without singletons
+    path = np.vstack((np.arange(19), np.arange(1, 20)))
+    tree = SingleLinkageTree(path, np.ones(19), 20)
+    for labels in tree.random_labels(15, 5, random_state=0):
+        assert len(np.unique(labels)) == 15
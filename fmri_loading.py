@@ -0,0 +1,123 @@
+""" Masking of 4D fMRI runs by chunks of time, into a reusable memmap
+
+The run is read through the nibabel array proxy, a few volumes at a time,
+optionally smoothed, and the voxels of the mask are written to a float32
+(n_samples, n_voxels) .npy memmap. Only one chunk is in memory, and the
+memmap is reused by the next analyses of the same run, mask and
+smoothing, which then skip the decompression.
+"""
+
+import os
+import json
+import numpy as np
+from scipy import ndimage
+
+from mask_geometry import mask_key
+
+
+def _load_img(img, keep_file_open=False):
+    """The nibabel image of img, a filename or an image
+
+    With keep_file_open, the image file is opened once for all the reads
+    of the data, instead of once per read. This makes consecutive reads of
+    a .nii.gz linear, instead of decompressing the file from its start at
+    each read.
+    """
+    import nibabel
+    if not isinstance(img, basestring):
+        filename = img.get_filename()
+        if not keep_file_open or filename is None:
+            return img
+        img = filename
+    if keep_file_open:
+        return nibabel.load(img, keep_file_open=True)
+    return nibabel.load(img)
+
+
+def _mask_data(mask):
+    if isinstance(mask, np.ndarray):
+        return mask.astype(bool)
+    return np.asarray(_load_img(mask).dataobj).astype(bool)
+
+
+def fwhm_to_sigma(fwhm, voxel_size):
+    """Gaussian sigma, in voxels, of a smoothing of fwhm mm"""
+    return fwhm / (np.sqrt(8 * np.log(2)) * np.asarray(voxel_size))
+
+
+def _source_key(img, mask, fwhm):
+    """What the content of the memmap depends on"""
+    key = {'mask': mask_key(mask), 'fwhm': fwhm,
+           'shape': list(img.shape)}
+    filename = img.get_filename()
+    if filename is not None:
+        key['source'] = os.path.abspath(filename)
+        key['mtime'] = os.path.getmtime(filename)
+    return key
+
+
+def mask_run(img, mask, filename, fwhm=None, chunk_size=None,
+             dtype=np.float32, reuse=True):
+    """Masked samples of a 4D run, as a (n_samples, n_voxels) memmap
+
+    img : string or nibabel image
+        The 4D run
+
+    mask : string, nibabel image or np.bool((n_x, n_y, n_z))
+        The mask, on the grid of the run
+
+    filename : string
+        The .npy file of the memmap. Its parameters are saved in
+        filename + '.json'.
+
+    fwhm : float, optional
+        Full width at half maximum, in mm, of a gaussian smoothing of each
+        volume
+
+    chunk_size : int, optional
+        Number of volumes read at a time, by default about 16M values
+
+    reuse : bool, optional
+        If True and filename holds the same run, mask and smoothing, it is
+        opened instead of being computed again
+
+    Returns the memmap, opened read-only.
+    """
+    img = _load_img(img, keep_file_open=True)
+    mask = _mask_data(mask)
+    if img.shape[:3] != mask.shape:
+        raise ValueError("The mask of shape %s does not match the run of "
+                         "shape %s" % (mask.shape, img.shape))
+    key = _source_key(img, mask, fwhm)
+    key_filename = filename + '.json'
+    if reuse and os.path.exists(filename) and os.path.exists(key_filename):
+        with open(key_filename) as f:
+            if json.load(f) == key:
+                return np.load(filename, mmap_mode='r')
+
+    n_samples = img.shape[3]
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 24 // int(np.prod(img.shape[:3])))
+    sigma = None
+    if fwhm:
+        sigma = tuple(fwhm_to_sigma(fwhm, img.header.get_zooms()[:3])) + (0,)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    if os.path.exists(key_filename):
+        os.remove(key_filename)
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                    shape=(n_samples, int(mask.sum())))
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        chunk = np.asarray(img.dataobj[..., start:stop], dtype=np.float64)
+        if sigma is not None:
+            chunk = ndimage.gaussian_filter(chunk, sigma)
+        out[start:stop] = chunk[mask].T
+    out.flush()
+    del out
+    # written last: an interrupted masking is not reused
+    with open(key_filename, 'w') as f:
+        json.dump(key, f, sort_keys=True)
+    return np.load(filename, mmap_mode='r')
@@ -23,25 +23,24 @@ from nilearn.input_data import NiftiLabelsMasker
 
 
 
-# Smooth the data
-from nilearn import image
+# Smooth and mask the data, by chunks of volumes, into a memmap reused by
+# the next runs of the script
+from fmri_loading import mask_run
 fmri_filename = haxby_dataset.func[0]
-fmri_img = image.smooth_img(fmri_filename, fwhm=6)
+fmri_data = mask_run(fmri_filename, haxby_dataset.mask,
+                     'cache/haxby_subj1_fwhm6.npy', fwhm=6)
 
-# Plot the mean image
+# Plot the mean image: smoothing commutes with the mean
+from nilearn import image
 from nilearn.plotting import plot_epi
-mean_img = image.mean_img(fmri_img)
+mean_img = image.smooth_img(image.mean_img(fmri_filename), fwhm=6)
 plot_epi(mean_img, title='Smoothed mean EPI', cut_coords=(36, -27, 66))
 
 
-from scipy import stats
-fmri_data = fmri_img.get_data()
-
-x_shape, y_shape, z_shape, t_shape = fri_data.reshape(x_shape * y_shape * z_shape, t_shape)
-
-condition_mask = np.logical_or(labels['labels'] == b'face',
-                               labels['labels'] == b'cat')
+condition_mask = np.logical_or(haxby_labels == b'face',
+                               haxby_labels == b'cat')
 target = haxby_labels[condition_mask]
+fmri_data = fmri_data[condition_mask]
 
 #######################
 ## Fit the stab_lasso #
@@ -11,7 +11,6 @@ stream.
 # Retrieve and load the Haxby dataset
 import numpy as np
 from sklearn.feature_selection import f_classif
-from sklearn.feature_extraction import image
 from nilearn import datasets
 from nilearn.input_data import NiftiMasker
 from nilearn.image import mean_img
@@ -20,6 +19,18 @@ from nilearn import plotting
 from sklearn.metrics import precision_recall_curve
 
 from stab_lasso import StabilityLasso
+from mask_geometry import get_mask_geometry
+from cv_runner import run_folds
+
+# number of folds fitted at the same time
+N_JOBS = -1
+
+
+def accuracy(model, X, y):
+    """Accuracy of the face (3) vs house (4) prediction of the model"""
+    prediction = 3 + (model.predict(X) > 3.5)
+    return np.sum(prediction == y) / float(np.size(y))
+
 
 haxby_dataset = datasets.fetch_haxby()
 # Load the behavioral labels
@@ -54,9 +65,7 @@ fmri_masked = fmri_masked[condition_mask]
 
 # Compute connectivity matrix: which voxel is connected to which
 mask = nifti_masker.mask_img_.get_data()
-shape = mask.shape
-connectivity = image.grid_to_graph(n_x=shape[0], n_y=shape[1],
-                                   n_z=shape[2], mask=mask)
+connectivity = get_mask_geometry(mask, cachedir='cache').connectivity
 
 ###########################################################################
 # Univariate testing on all the sessions
@@ -103,13 +112,9 @@ display.close()
 from sklearn.cross_validation import KFold, LabelKFold
 
 cv = LabelKFold(sessions, n_folds=6)
-cv_scores = []
-
-for train, test in cv:
-    model.fit(fmri_masked[train], target[train], connectivity=connectivity)
-    prediction = 3 + (model.predict(fmri_masked[test]) > 3.5)
-    cv_scores.append(np.sum(prediction == target[test])
-                     / float(np.size(target[test])))
+cv_scores, _ = run_folds(model, fmri_masked, target, cv,
+                         fit_params=dict(connectivity=connectivity),
+                         scorer=accuracy, n_jobs=N_JOBS)
 print(cv_scores)
 print(np.mean(cv_scores))
 """
@@ -138,20 +143,27 @@ plot_stat_map(coef_img, mean_epi, title="SVM weights", display_mode="yx")
 from sklearn.cross_validation import LabelShuffleSplit
 from sklearn import metrics
 
-# run a model on all the data
+# run a model on all the data: its coefficients are the reference of the
+# subsamples of every proportion (the sequential loop used to compare the
+# proportions after the first one with the last fit of the previous one)
 model.fit(fmri_masked, target, connectivity=connectivity)
-
-for proportion in [1. / 6, 1./4, 1./3, 1./2]:
-    slo = LabelShuffleSplit(sessions, n_iter=10, train_size=proportion,
+coef_all = model.coef_
+bin_coef_all = np.abs(coef_all) > np.percentile(np.abs(coef_all), 10)
+
+# fit the subsamples of all the proportions at once
+proportions = [1. / 6, 1./4, 1./3, 1./2]
+n_iter = 10
+subsamples = []
+for proportion in proportions:
+    slo = LabelShuffleSplit(sessions, n_iter=n_iter, train_size=proportion,
                             random_state=0)
-    # get the coefs:
-    coef_all = model.coef_
-    bin_coef_all = np.abs(coef_all) > np.percentile(np.abs(coef_all), 10)
-    coefs = []
-    for train, _ in slo:
-        coefs.append(model.fit(fmri_masked[train], target[train],
-                               connectivity=connectivity).coef_)
+    subsamples.extend((train, None) for train, _ in slo)
+_, all_coefs = run_folds(model, fmri_masked, target, subsamples,
+                         fit_params=dict(connectivity=connectivity),
+                         n_jobs=N_JOBS)
 
+for i, proportion in enumerate(proportions):
+    coefs = all_coefs[i * n_iter:(i + 1) * n_iter]
     auc = []
     for coef in coefs:
         fpr, tpr, _ = precision_recall_curve(bin_coef_all, np.abs(coef))
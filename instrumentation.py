@@ -0,0 +1,213 @@
+""" Low-overhead instrumentation of the stages of the stability lasso
+
+StabilityLasso(profile=True) records, for each stage (scaling, clustering,
+pp_inv, lasso, ols, univariate tests, aggregation), the cumulative wall
+time, the number of calls and optionally the peak memory, in total and
+per split, as well as the Lasso iteration counts and convergence warnings.
+When profiling is disabled, the stages go through NULL_PROFILER, which
+does nothing.
+"""
+
+import sys
+import time
+import warnings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _memory_backend():
+    """'tracemalloc' (Python >= 3.9), 'rusage' (Unix) or None"""
+    if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+        return 'tracemalloc'
+    if resource is not None:
+        return 'rusage'
+    return None
+
+
+def _max_rss():
+    """Peak resident memory of the process so far, in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on OS X
+    return max_rss if sys.platform == 'darwin' else 1024 * max_rss
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullProfiler(object):
+    """Profiler that records nothing"""
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name, split=None, record_warnings=False):
+        return self._stage
+
+    def lasso_iterations(self, n_iter):
+        pass
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, split, record_warnings):
+        self.profiler = profiler
+        self.name = name
+        self.split = split
+        self.record_warnings = record_warnings
+
+    def __enter__(self):
+        if self.record_warnings:
+            self._catch = warnings.catch_warnings(record=True)
+            self._warnings = self._catch.__enter__()
+            warnings.simplefilter('always')
+        if self.profiler.memory:
+            self._memory = self.profiler._start_memory()
+        self._t0 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self._t0
+        peak = None
+        if self.profiler.memory:
+            peak = self.profiler._stop_memory(self._memory)
+        if self.record_warnings:
+            self._catch.__exit__(*exc_info)
+            self.profiler._warnings(self._warnings)
+        self.profiler._record(self.name, self.split, elapsed, peak)
+        return False
+
+
+class StageProfiler(object):
+    """Cumulative wall time, calls and peak memory per stage and per split
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Called as callback(stage, split, elapsed) at the end of each stage.
+        split is None for the stages that are not specific to a split.
+
+    memory : bool, optional
+        Whether to record the peak memory (in bytes) allocated during each
+        stage. With Python >= 3.9, it is measured with tracemalloc: unless
+        it is already tracing, tracemalloc is started at the beginning of
+        the outermost stage and stopped at its end, so that it does not
+        slow down the code outside of the stages. Otherwise, on Unix, it is
+        the growth of the peak resident memory of the process
+        (getrusage), which is 0 for the stages that stay below an earlier
+        peak. A warning is raised if neither is available.
+
+    Attributes
+    ----------
+    stages : dict
+        {stage: {'time': seconds, 'calls': int, 'peak_memory': bytes}}
+
+    splits : dict
+        {split: {stage: {'time': seconds, 'peak_memory': bytes}}}
+
+    lasso_n_iter : list of int
+        Number of iterations of each Lasso fit
+
+    convergence_warnings : int
+        Number of ConvergenceWarning raised by the Lasso fits
+    """
+    enabled = True
+
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory_backend = _memory_backend() if memory else None
+        if memory and self.memory_backend is None:
+            warnings.warn("The peak memory can not be recorded: it needs "
+                          "tracemalloc (Python >= 3.9) or the resource "
+                          "module")
+        self.memory = self.memory_backend is not None
+        self._depth = 0
+        self._started_tracing = False
+        self.stages = {}
+        self.splits = {}
+        self.lasso_n_iter = []
+        self.convergence_warnings = 0
+
+    def stage(self, name, split=None, record_warnings=False):
+        """Context manager timing one call of a stage"""
+        return _Stage(self, name, split, record_warnings)
+
+    def lasso_iterations(self, n_iter):
+        self.lasso_n_iter.append(int(n_iter))
+
+    def _start_memory(self):
+        """Reference of the peak memory of a stage that starts"""
+        if self.memory_backend == 'rusage':
+            return _max_rss()
+        if self._depth == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._depth += 1
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return memory
+
+    def _stop_memory(self, memory):
+        """Peak memory of a stage that ends, above its reference"""
+        if self.memory_backend == 'rusage':
+            return _max_rss() - memory
+        peak = tracemalloc.get_traced_memory()[1] - memory
+        self._depth -= 1
+        if self._depth == 0 and self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return peak
+
+    def _warnings(self, caught):
+        for warning in caught:
+            if warning.category.__name__ == 'ConvergenceWarning':
+                self.convergence_warnings += 1
+            # they were caught only to be counted
+            warnings.warn_explicit(warning.message, warning.category,
+                                   warning.filename, warning.lineno)
+
+    def _record(self, name, split, elapsed, peak):
+        stage = self.stages.setdefault(
+            name, {'time': 0., 'calls': 0, 'peak_memory': None})
+        stage['time'] += elapsed
+        stage['calls'] += 1
+        if peak is not None:
+            stage['peak_memory'] = max(stage['peak_memory'] or 0, peak)
+        if split is not None:
+            split_stage = self.splits.setdefault(split, {}).setdefault(
+                name, {'time': 0., 'peak_memory': None})
+            split_stage['time'] += elapsed
+            if peak is not None:
+                split_stage['peak_memory'] = max(
+                    split_stage['peak_memory'] or 0, peak)
+        if self.callback is not None:
+            self.callback(name, split, elapsed)
+
+    def summary(self):
+        """Table of the stages, sorted by decreasing cumulative time"""
+        lines = ['%-28s %10s %8s %12s' % ('stage', 'time (s)', 'calls',
+                                         'peak (MB)')]
+        for name, stage in sorted(self.stages.items(),
+                                  key=lambda item: - item[1]['time']):
+            peak = stage['peak_memory']
+            lines.append('%-28s %10.4f %8d %12s' % (
+                name, stage['time'], stage['calls'],
+                '-' if peak is None else '%.1f' % (peak / 2. ** 20)))
+        if self.lasso_n_iter:
+            lines.append('lasso iterations: %d (max %d), '
+                         'convergence warnings: %d' % (
+                             sum(self.lasso_n_iter), max(self.lasso_n_iter),
+                             self.convergence_warnings))
+        return '\n'.join(lines)
@@ -0,0 +1,246 @@
+"""
+=====================================================
+Simulated datasets larger than memory, for scale tests
+=====================================================
+
+The models of univariate_simulation and multivariate_simulation, on a
+brain-like mask of realistic shape (91 x 109 x 91 by default), with an
+arbitrary layout of ROIs. The samples are generated by blocks and written
+to a .npy memmap, together with the ground truth beta0, the mask and its
+cached connectivity graph::
+
+    python large_simulation.py directory [n_samples]
+
+The dataset is read back with load_simulation.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+from scipy import linalg
+
+from sklearn.utils import check_random_state
+
+from mask_geometry import get_mask_geometry
+from plot_simulated_data import generate_w, smooth_volumes, ROI_SIZE
+
+BRAIN_SHAPE = (91, 109, 91)
+
+
+def brain_mask(shape=BRAIN_SHAPE):
+    """Brain-like mask: the ellipsoid inscribed in the volume"""
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    radius = sum(((g - (s - 1) / 2.) / (s / 2.)) ** 2
+                 for g, s in zip(grid, shape))
+    return radius <= 1.
+
+
+def _generate_w_rois(box, roi_size):
+    """The (corner, size, weight) of the 5 ROIs of generate_w, in a box"""
+    box = np.asarray(box)
+    low, high = np.zeros_like(box), box - roi_size
+    layout = [((0, 0, 0), -.6), ((1, 1, 0), .5), ((0, 1, 1), -.6),
+              ((1, 0, 1), .5)]
+    rois = [(np.where(side, high, low), roi_size, weight)
+            for side, weight in layout]
+    rois.append((high // 2, roi_size, .5))
+    return rois
+
+
+def _default_rois(mask, roi_size):
+    """The ROIs of generate_w, laid out in the bounding box of the mask,
+    shrunk until all the ROIs are in the mask"""
+    lower = np.array([index.min() for index in np.where(mask)])
+    upper = np.array([index.max() + 1 for index in np.where(mask)])
+    while np.all(upper - lower >= roi_size):
+        rois = [(lower + corner, size, weight) for corner, size, weight in
+                _generate_w_rois(upper - lower, roi_size)]
+        if all(mask[tuple(slice(c, c + size) for c in corner)].all()
+               for corner, size, _ in rois):
+            return rois
+        lower, upper = lower + 1, upper - 1
+    raise ValueError("The ROIs of side %d of generate_w do not fit in the "
+                     "mask" % roi_size)
+
+
+def roi_weights(shape, rois=None, roi_size=ROI_SIZE, mask=None,
+                random_state=None):
+    """Weights of the ROIs, as a (shape + (n_rois,)) array like generate_w
+
+    rois : None, int or list of (corner, size, weight), optional
+        None gives the 5 ROIs of generate_w, laid out in the bounding box
+        of the mask, shrunk until they are all in the mask: with a full
+        mask, they are those of generate_w. An int gives that many cubes
+        of side roi_size, at random positions in the mask, with weights
+        +/-0.5. A list gives the corner (x, y, z), side and weight of each
+        cube.
+
+    Raises a ValueError if an ROI has no voxel in the mask.
+    """
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    if rois is None:
+        rois = _default_rois(mask, roi_size)
+    elif isinstance(rois, int):
+        generator = check_random_state(random_state)
+        # corners such that the cube fits in the volume and its corner is
+        # in the mask
+        corners = np.array(np.where(mask)).T
+        corners = corners[np.all(corners <= np.array(shape) - roi_size,
+                                 axis=1)]
+        corners = corners[generator.permutation(len(corners))[:rois]]
+        signs = generator.randint(2, size=len(corners)) * 2 - 1
+        rois = [(corner, roi_size, .5 * sign)
+                for corner, sign in zip(corners, signs)]
+
+    w = np.zeros(tuple(shape) + (len(rois),))
+    for i, (corner, size, weight) in enumerate(rois):
+        w[tuple(slice(c, c + size) for c in corner) + (i,)] = weight
+    w *= mask[..., np.newaxis]
+    empty = np.where(~w.reshape(-1, len(rois)).any(axis=0))[0]
+    if len(empty):
+        raise ValueError("The ROIs %s have no voxel in the mask"
+                         % empty.tolist())
+    return w
+
+
+def _smoothed_blocks(generator, n_samples, shape, mask, smooth_X,
+                     smooth_method, block_size):
+    """Blocks of masked smooth noise, drawn as in smooth_noise"""
+    in_mask = mask.ravel()
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        volumes = generator.randn(stop - start, *shape)
+        volumes = smooth_volumes(volumes, smooth_X, smooth_method)
+        yield start, stop, volumes.reshape(stop - start, -1)[:, in_mask]
+
+
+def simulate_to_disk(directory, n_samples=1000, shape=BRAIN_SHAPE,
+                     mask=None, model='univariate', snr=0, rois=None,
+                     roi_size=ROI_SIZE, modulation=False, smooth_X=1,
+                     smooth_method='direct', dtype=np.float32,
+                     block_size=None, random_state=1):
+    """Write a simulated dataset to directory, by blocks of samples
+
+    directory : string
+        Where X.npy, y.npy, beta0.npy, mask.npy, the mask geometry and the
+        parameters are written
+
+    mask : np.bool(shape), optional
+        Defaults to brain_mask(shape). X only holds the voxels in the mask.
+
+    model : 'univariate' or 'multivariate', optional
+        The model of univariate_simulation or multivariate_simulation. With
+        a full mask and the default ROIs, the data are those of these
+        functions for the same seed, up to rounding and dtype (except
+        with modulation, where univariate_simulation lays the ROIs out in
+        transposed order).
+
+    rois : None, int or list, optional
+        See roi_weights
+
+    block_size : int, optional
+        Number of samples generated at a time, by default about 4M voxels
+
+    Returns X (a read-only memmap), y, beta0 and the mask
+    """
+    generator = check_random_state(random_state)
+    if mask is None:
+        mask = brain_mask(shape)
+    mask = np.asarray(mask).astype(bool)
+    shape = mask.shape
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // int(np.prod(shape)))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    w = roi_weights(shape, rois, roi_size, mask, random_state=generator)
+    w = w.reshape(-1, w.shape[-1])[mask.ravel()].T
+    if not (model == 'univariate' and modulation):
+        w = w.sum(0)[np.newaxis]
+    n_voxels = w.shape[1]
+    support = np.where(w.sum(0) != 0)[0]
+
+    X = np.lib.format.open_memmap(os.path.join(directory, 'X.npy'),
+                                  mode='w+', dtype=dtype,
+                                  shape=(n_samples, n_voxels))
+    blocks = _smoothed_blocks(generator, n_samples, shape, mask, smooth_X,
+                              smooth_method, block_size)
+    if model == 'univariate':
+        # first pass: the noise, and the Gram matrix of its restriction to
+        # the support, whose spectral norm sets the snr
+        gram = np.zeros((len(support), len(support)))
+        for start, stop, noise in blocks:
+            X[start:stop] = noise
+            gram += noise[:, support].T.dot(noise[:, support])
+
+        y_ = generator.randn(n_samples, 1)
+        if modulation:
+            modulation_ = generator.rand(n_samples, w.shape[0])
+            y = y_ * (.1 + .9 * (modulation_.T >= modulation_.max(1))).T
+        else:
+            y = y_
+        # ||y w|| = ||R w|| with y = QR
+        R = linalg.qr(y, mode='r')[0]
+        norm_noise = linalg.norm(R.dot(w[:, support]), 2) / np.exp(snr / 20.)
+        noise_coef = norm_noise / np.sqrt(linalg.eigvalsh(gram)[-1])
+
+        # second pass: signal + noise, standardized
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            X_ = np.dot(y[start:stop], w)
+            X_ += noise_coef * X[start:stop]
+            X_ -= X_.mean(axis=-1)[:, np.newaxis]
+            X_ /= X_.std(axis=-1)[:, np.newaxis]
+            X[start:stop] = X_
+        y = np.ravel(y_)
+    elif model == 'multivariate':
+        y = np.zeros((n_samples, 1))
+        for start, stop, X_ in blocks:
+            X[start:stop] = X_
+            y[start:stop] = np.dot(X_, w.T)
+        noise = generator.randn(len(y), 1)
+        norm_noise = linalg.norm(y) / linalg.norm(noise) / np.exp(snr / 20.)
+        y = np.ravel(y + noise * norm_noise)
+    else:
+        raise ValueError("Unknown model: %s" % model)
+    X.flush()
+    del X
+
+    beta0 = w.sum(0)
+    np.save(os.path.join(directory, 'y.npy'), y)
+    np.save(os.path.join(directory, 'beta0.npy'), beta0)
+    np.save(os.path.join(directory, 'mask.npy'), mask)
+    get_mask_geometry(mask, cachedir=directory)
+    with open(os.path.join(directory, 'params.json'), 'w') as f:
+        json.dump({'n_samples': n_samples, 'shape': list(shape),
+                   'n_voxels': n_voxels, 'model': model, 'snr': snr,
+                   'modulation': modulation, 'smooth_X': smooth_X,
+                   'smooth_method': smooth_method,
+                   'dtype': np.dtype(dtype).name,
+                   'random_state': (random_state if isinstance(
+                       random_state, int) else None)},
+                  f, indent=1, sort_keys=True)
+    return (np.load(os.path.join(directory, 'X.npy'), mmap_mode='r'),
+            y, beta0, mask)
+
+
+def load_simulation(directory, mmap_mode='r'):
+    """X (memmap), y, beta0 and the connectivity of a simulated dataset"""
+    X = np.load(os.path.join(directory, 'X.npy'), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(directory, 'y.npy'))
+    beta0 = np.load(os.path.join(directory, 'beta0.npy'))
+    mask = np.load(os.path.join(directory, 'mask.npy'))
+    connectivity = get_mask_geometry(mask, cachedir=directory).connectivity
+    return X, y, beta0, connectivity
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    X, _, beta0, _ = simulate_to_disk(sys.argv[1], n_samples=n_samples)
+    print('%d samples x %d voxels, %d active voxels, written to %s' % (
+        X.shape[0], X.shape[1], np.sum(beta0 != 0), sys.argv[1]))
@@ -4,21 +4,21 @@ from scipy.sparse import coo_matrix
 import matplotlib.pyplot as plt
 
 from stab_lasso import StabilityLasso, select_model_fdr
-from sklearn.metrics import roc_curve, precision_recall_curve
+from mask_geometry import get_mask_geometry
+from result_store import ResultStore
+from accumulators import DetectionAccumulator
 from scipy.stats import pearsonr
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, cpu_count
 
 from plot_simulated_data import (univariate_simulation, plot_slices, plot_row_slices,
                                  multivariate_simulation)
 
 SHAPE = (12, 12, 12)
+ALPHAS = [.01, .05, .1, .2]
 
 
 def connectivity(shape):
-    from sklearn.feature_extraction import image
-    connectivity = image.grid_to_graph(n_x=shape[0], n_y=shape[1],
-                                       n_z=shape[2])
-    return connectivity
+    return get_mask_geometry(np.ones(shape, dtype=bool)).connectivity
 
 
 def pedagogical_example(shape=SHAPE, n_samples=100, split_ratio=.3, n_split=20,
@@ -39,14 +39,12 @@ def pedagogical_example(shape=SHAPE, n_samples=100, split_ratio=.3, n_split=20,
     anova_model = select_model_fdr(pvals, alpha)
     coefs['anova'] = np.reshape(- np.log(
             (pvals * len(anova_model)).clip(0, 1)) * anova_model, shape)
-    connectivity_ = connectivity(shape)
+    # run the stablasso, whose fit does not depend on the model selection
+    stability_lasso = StabilityLasso(
+        theta, n_split=n_split, ratio_split=split_ratio, n_clusters=k)
+    stability_lasso.fit(X, y, connectivity(shape))
     for model_selection in ['univariate', 'multivariate', 'scores']:
-        # run the stablasso
-        stability_lasso = StabilityLasso(
-            theta, n_split=n_split, ratio_split=split_ratio,
-            n_clusters=k, model_selection=model_selection)
-        stability_lasso.fit(X, y, connectivity_)
-        if model_selection is 'univariate':
+        if model_selection == 'univariate':
             pvals = stability_lasso.univariate_split_pval(X, y)
         else:
             pvals = stability_lasso.multivariate_split_pval(X, y)
@@ -72,64 +70,32 @@ def stat_test(model_selection='multivariate',
               shape=SHAPE):
 
     size = np.prod(shape)
-    k = int(size / mean_size_clust)
 
-    X, y, snr, noise, beta0, _ = \
-        univariate_simulation(snr, n_samples, shape, random_seed,
-                              modulation=True)
-    true_coeff = beta0 ** 2 > 0
+    X, y, true_coeff = _simulate(n_samples, snr, random_seed, shape)
 
     if model_selection == 'anova':
-        pvals = np.array([pearsonr(y, x)[1] for x in X.T])
-        selected_model = select_model_fdr(pvals, alpha)
-        false_discovery = selected_model * (~true_coeff)
-        true_discovery = selected_model * true_coeff
-        undiscovered = true_coeff.sum() - true_discovery.sum()
-        fdr = (float(false_discovery.sum()) /
-               max(1., float(selected_model.sum())))
-        recall = float(true_discovery.sum()) / np.sum(true_coeff)
+        pvals, scores, selected_models = _infer(
+            None, X, y, model_selection, [control_type], [alpha])
+        fdr, recall = _discovery_rates(
+            selected_models[control_type, alpha], true_coeff)[:2]
         return fdr, recall, pvals, pvals, true_coeff
 
-    connectivity_ = connectivity(shape)
-    stability_lasso = StabilityLasso(
-        theta, n_split=n_split, ratio_split=split_ratio,
-        n_clusters=k, model_selection=model_selection)
-
-    stability_lasso.fit(X, y, connectivity_)
+    stability_lasso = _fit(X, y, n_split, split_ratio, mean_size_clust,
+                           theta, shape)
     beta = stability_lasso._soln
 
-    if model_selection == 'univariate':
-        pvals = stability_lasso.univariate_split_pval(X, y)
-        scores = pvals
-        selected_model = stability_lasso.select_model_fdr(alpha)
-    elif model_selection == 'multivariate':
-        pvals = stability_lasso.multivariate_split_pval(X, y)
-        scores = stability_lasso.multivariate_split_scores(X, y)
-        if control_type == 'pvals':
-            selected_model = stability_lasso.select_model_fdr(
-                alpha, normalize=False)
-        elif control_type == 'scores':
-            selected_model = stability_lasso.select_model_fdr_scores(
-                alpha, normalize=False)
-    else:
-        raise ValueError("This model selection method doesn't exist")
+    pvals, scores, selected_models = _infer(
+        stability_lasso, X, y, model_selection, [control_type], [alpha])
+    selected_model = selected_models[control_type, alpha]
 
     beta_corrected = np.zeros(size)
     if len(selected_model) > 0:
         beta_corrected[selected_model] = beta[selected_model]
-        false_discovery = selected_model * (~true_coeff)
-        true_discovery = selected_model * true_coeff
-    else:
-        false_discovery = np.array([])
-        true_discovery  = np.array([])
 
+    fdr, recall, true_discovery, false_discovery = _discovery_rates(
+        selected_model, true_coeff)
     undiscovered = true_coeff.sum() - true_discovery.sum()
 
-    fdr = (float(false_discovery.sum()) /
-           max(1., float(selected_model.sum())))
-
-    recall = float(true_discovery.sum()) / np.sum(true_coeff)
-
     if print_results:
         print("------------------- RESULTS -------------------")
         print("-----------------------------------------------")
@@ -158,6 +124,267 @@ def stat_test(model_selection='multivariate',
     return fdr, recall, pvals, scores, true_coeff
 
 
+def _simulate(n_samples, snr, random_seed, shape):
+    """Dataset of stat_test: X, y and the true support"""
+    X, y, snr, noise, beta0, _ = \
+        univariate_simulation(snr, n_samples, shape, random_seed,
+                              modulation=True)
+    return X, y, beta0 ** 2 > 0
+
+
+def _fit(X, y, n_split, split_ratio, mean_size_clust, theta, shape):
+    """StabilityLasso of stat_test, fitted on X, y
+
+    The fit does not depend on the model selection: every inference
+    can be run on it.
+    """
+    k = int(np.prod(shape) / mean_size_clust)
+    stability_lasso = StabilityLasso(
+        theta, n_split=n_split, ratio_split=split_ratio, n_clusters=k)
+    return stability_lasso.fit(X, y, connectivity(shape))
+
+
+def _infer(stability_lasso, X, y, model_selection, control_types, alphas):
+    """p-values, scores and selected models of one model selection
+
+    The models selected for every control type and alpha are returned
+    as a {(control_type, alpha): selected_model} dict. For 'univariate'
+    and 'anova', which only control the p-values, control_type is ignored.
+    """
+    selected_models = {}
+    if model_selection == 'anova':
+        pvals = np.array([pearsonr(y, x)[1] for x in X.T])
+        scores = pvals
+        for control_type in control_types:
+            for alpha in alphas:
+                selected_models[control_type, alpha] = select_model_fdr(
+                    pvals, alpha)
+    elif model_selection == 'univariate':
+        pvals = stability_lasso.univariate_split_pval(X, y)
+        scores = pvals
+        for control_type in control_types:
+            for alpha in alphas:
+                selected_models[control_type, alpha] = \
+                    stability_lasso.select_model_fdr(alpha)
+    elif model_selection == 'multivariate':
+        pvals = stability_lasso.multivariate_split_pval(X, y)
+        scores = stability_lasso.multivariate_split_scores(X, y)
+        for control_type in control_types:
+            for alpha in alphas:
+                if control_type == 'pvals':
+                    selected_model = stability_lasso.select_model_fdr(
+                        alpha, normalize=False)
+                elif control_type == 'scores':
+                    selected_model = stability_lasso.select_model_fdr_scores(
+                        alpha, normalize=False)
+                else:
+                    raise ValueError("Unknown control type: %s" %
+                                     control_type)
+                selected_models[control_type, alpha] = selected_model
+    else:
+        raise ValueError("This model selection method doesn't exist")
+    return pvals, scores, selected_models
+
+
+def _discovery_rates(selected_model, true_coeff):
+    """fdr, recall, true and false discoveries of a selected model"""
+    if len(selected_model) > 0:
+        false_discovery = selected_model * (~true_coeff)
+        true_discovery = selected_model * true_coeff
+    else:
+        false_discovery = np.array([])
+        true_discovery = np.array([])
+    fdr = (float(false_discovery.sum()) /
+           max(1., float(selected_model.sum())))
+    recall = float(true_discovery.sum()) / np.sum(true_coeff)
+    return fdr, recall, true_discovery, false_discovery
+
+
+def stat_test_grid(model_selections=('multivariate',),
+                   control_types=('pvals',), alphas=(.2,), n_samples=100,
+                   n_split=1, split_ratio=.4, mean_size_clust=1, theta=0.1,
+                   snr=-10, random_seed=1, shape=SHAPE):
+    """stat_test for every model selection, control type and alpha
+
+    The dataset is generated once, and the StabilityLasso is fitted once
+    for all the model selections; each inference is run once for all
+    control types and alphas. The results are those of the separate
+    stat_test calls.
+
+    Returns {(model_selection, control_type, alpha): (fdr, recall, pvals,
+    scores, true_coeff)}
+    """
+    X, y, true_coeff = _simulate(n_samples, snr, random_seed, shape)
+    stability_lasso = None
+    if any(model_selection != 'anova' for model_selection in model_selections):
+        stability_lasso = _fit(X, y, n_split, split_ratio, mean_size_clust,
+                               theta, shape)
+
+    results = {}
+    for model_selection in model_selections:
+        pvals, scores, selected_models = _infer(
+            stability_lasso, X, y, model_selection, control_types, alphas)
+        for (control_type, alpha), selected_model in selected_models.items():
+            fdr, recall = _discovery_rates(selected_model, true_coeff)[:2]
+            results[model_selection, control_type, alpha] = (
+                fdr, recall, pvals, scores, true_coeff)
+    return results
+
+
+def _result_params(params):
+    """Full parameters of a stat_test call, defaults included, that
+    determine its result"""
+    code = stat_test.__code__
+    names = code.co_varnames[:code.co_argcount]
+    result_params = dict(zip(names[-len(stat_test.__defaults__):],
+                             stat_test.__defaults__))
+    result_params.update(params)
+    result_params.pop('plot')
+    result_params.pop('print_results')
+    return result_params
+
+
+def _call(func, params, limit_threads=False):
+    """func(**params), with a single BLAS thread if limit_threads, to
+    avoid oversubscription in parallel workers"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        limit_threads = False
+    if not limit_threads:
+        return func(**params)
+    with threadpool_limits(limits=1):
+        return func(**params)
+
+
+def _run_stat_test(params, limit_threads=False, store=None):
+    """stat_test(**params) in a worker. The result is saved in store, if
+    given."""
+    result = _call(stat_test, params, limit_threads)
+    if store is not None:
+        store.put(_result_params(params), result)
+    return result
+
+
+def _grid_cells(params, model_selections, control_types, alphas):
+    """Parameters of the stat_test calls of a stat_test_grid call"""
+    return [dict(params, model_selection=model_selection,
+                 control_type=control_type, alpha=alpha, plot=False,
+                 print_results=False)
+            for model_selection in model_selections
+            for control_type in control_types for alpha in alphas]
+
+
+def _run_stat_test_grid(params, grid, limit_threads=False, store=None):
+    """stat_test_grid in a worker. The result of each cell is saved in
+    store, if given, as that of the corresponding stat_test call."""
+    results = _call(stat_test_grid, dict(params, **grid), limit_threads)
+    if store is not None:
+        for cell in _grid_cells(params, **grid):
+            store.put(_result_params(cell), results[
+                cell['model_selection'], cell['control_type'],
+                cell['alpha']])
+    return results
+
+
+def repeat_stat_test(n_test, rs_start=1, n_jobs=1, store=None, **params):
+    """Run stat_test n_test times with the seeds rs_start + i
+
+    The repetitions run in n_jobs worker processes; the results are
+    returned in the order of the seeds.
+
+    store : ResultStore or string, optional
+        Store (or its directory) where each result is saved as soon as it
+        is computed. The repetitions already in the store are read instead
+        of being run again.
+    """
+    params.setdefault('print_results', False)
+    if store is not None and not isinstance(store, ResultStore):
+        store = ResultStore(store)
+    cells = [dict(params, random_seed=rs_start + i) for i in range(n_test)]
+    todo = [cell for cell in cells
+            if store is None or _result_params(cell) not in store]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_run_stat_test)(cell, limit_threads=n_jobs != 1,
+                                store=store)
+        for cell in todo)
+    if store is None:
+        return results
+    # also indexes the results of an interrupted previous run
+    store.update_index([_result_params(cell) for cell in cells])
+    return [store.get(_result_params(cell)) for cell in cells]
+
+
+def iter_stat_test(n_test, rs_start=1, n_jobs=1, store=None, batch_size=None,
+                   **params):
+    """repeat_stat_test, yielding the results in the order of the seeds
+
+    The repetitions are run by batches of batch_size (by default 4 per
+    worker), so that only the results of a batch are held in memory.
+    """
+    if batch_size is None:
+        n_workers = n_jobs if n_jobs > 0 else max(1, cpu_count() + 1 + n_jobs)
+        batch_size = 4 * n_workers
+    for start in range(0, n_test, batch_size):
+        for result in repeat_stat_test(
+                min(batch_size, n_test - start), rs_start=rs_start + start,
+                n_jobs=n_jobs, store=store, **params):
+            yield result
+
+
+def _fdr_selection(model_selection):
+    """select(values, alpha) of DetectionAccumulator, the
+    Benjamini-Hochberg procedure of _infer for model_selection: normalized
+    for 'univariate', not for 'anova' nor for the p-values and scores of
+    'multivariate'"""
+    normalize = model_selection == 'univariate'
+
+    def select(values, alpha):
+        return select_model_fdr(values, alpha, normalize=normalize)
+    return select
+
+
+def _print_fdr_recall(accumulator):
+    alphas, fdr, recall, fwer = accumulator.fdr_recall()
+    for alpha, fdr_, recall_, fwer_ in zip(alphas, fdr, recall, fwer):
+        print('alpha %0.2f: average fdr %0.3f, average recall %0.3f, '
+              'fwer %0.3f' % (alpha, fdr_, recall_, fwer_))
+
+
+def repeat_stat_test_grid(n_test, model_selections=('multivariate',),
+                          control_types=('pvals',), alphas=(.2,),
+                          rs_start=1, n_jobs=1, store=None, **params):
+    """Run stat_test_grid n_test times with the seeds rs_start + i
+
+    The repetitions run in n_jobs worker processes; the results are
+    returned in the order of the seeds. The cells are stored, and read
+    from store, as the corresponding stat_test calls of repeat_stat_test:
+    a repetition is only run if one of its cells is missing.
+    """
+    if store is not None and not isinstance(store, ResultStore):
+        store = ResultStore(store)
+    grid = dict(model_selections=model_selections,
+                control_types=control_types, alphas=alphas)
+    seeds = [dict(params, random_seed=rs_start + i) for i in range(n_test)]
+    todo = [seed for seed in seeds if store is None or not all(
+        _result_params(cell) in store
+        for cell in _grid_cells(seed, **grid))]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_run_stat_test_grid)(seed, grid, limit_threads=n_jobs != 1,
+                                     store=store)
+        for seed in todo)
+    if store is None:
+        return results
+
+    cells = [_grid_cells(seed, **grid) for seed in seeds]
+    store.update_index([_result_params(cell)
+                        for seed_cells in cells for cell in seed_cells])
+    return [dict(((cell['model_selection'], cell['control_type'],
+                   cell['alpha']), store.get(_result_params(cell)))
+                 for cell in seed_cells)
+            for seed_cells in cells]
+
+
 def multiple_test(n_test,
                   model_selection='multivariate',
                   control_type='pvals',
@@ -170,7 +397,9 @@ def multiple_test(n_test,
                   rs_start=1,
                   plot=False,
                   alpha=.05,
-                  shape=SHAPE):
+                  shape=SHAPE,
+                  n_jobs=1,
+                  store=None):
     """Runs several tests and accumulate results
 
     Parameters
@@ -218,48 +447,51 @@ def multiple_test(n_test,
 
     shape: tuple of int, optional,
           shape of the data volume
+
+    n_jobs: int, optional,
+          number of processes running the tests
+
+    store: ResultStore or string, optional,
+          where the results are saved, and read from if already computed
     """
-    fdr_array = []
-    recall_array = []
-    pvals = []
-    scores = []
-    true_coeffs = []
-
-    for i in range(n_test):
-        fdr, recall, pval, score, true_coeff = stat_test(
-            model_selection=model_selection,
-            control_type=control_type,
-            n_samples=n_samples,
-            n_split=n_split,
-            split_ratio=split_ratio,
-            mean_size_clust=mean_size_clust,
-            theta=theta,
-            snr=snr,
-            random_seed=rs_start + i,
-            print_results=False,
-            plot=plot,
-            alpha=alpha,
-            shape=shape)
-        fdr_array.append(fdr)
-        recall_array.append(recall)
-        pvals.append(pval)
-        scores.append(score)
-        true_coeffs.append(true_coeff)
+    res = repeat_stat_test(
+        n_test, rs_start=rs_start, n_jobs=n_jobs, store=store,
+        model_selection=model_selection,
+        control_type=control_type,
+        n_samples=n_samples,
+        n_split=n_split,
+        split_ratio=split_ratio,
+        mean_size_clust=mean_size_clust,
+        theta=theta,
+        snr=snr,
+        plot=plot,
+        alpha=alpha,
+        shape=shape)
+    fdr_array = [res_[0] for res_ in res]
+    recall_array = [res_[1] for res_ in res]
 
     return np.array(fdr_array), np.array(recall_array)
 
 
 def experiment_nominal_control(control_type='scores', n_splits=[20],
-                               clust_sizes=[1], n_test=20):
+                               clust_sizes=[1], n_test=20, n_jobs=1,
+                               store=None):
     """This experiments checks empirically type I error rate/fdr"""
+    model_selections = ['univariate', 'multivariate']
     for n_split in n_splits:
         for mean_size_clust in clust_sizes:
-            for model_selection in ['univariate', 'multivariate']:
-                fdr_array, recall_array = multiple_test(
-                    model_selection=model_selection, control_type='scores',
-                    n_test=n_test, n_split=n_split,
-                    mean_size_clust=mean_size_clust,
-                    split_ratio=.5, plot=False, alpha=1., theta=.9, snr=-10)
+            # both model selections share the datasets and the fits
+            res = repeat_stat_test_grid(
+                n_test, model_selections=model_selections,
+                control_types=['scores'], alphas=[1.], n_jobs=n_jobs,
+                store=store, n_samples=100, n_split=n_split,
+                split_ratio=.5, mean_size_clust=mean_size_clust, theta=.9,
+                snr=-10, shape=SHAPE)
+            for model_selection in model_selections:
+                fdr_array = np.array([res_[model_selection, 'scores', 1.][0]
+                                      for res_ in res])
+                recall_array = np.array(
+                    [res_[model_selection, 'scores', 1.][1] for res_ in res])
                 print('model selection %s cluster_size %d, n_split %d' % (
                         model_selection, mean_size_clust, n_split))
                 print('average fdr: %0.3f' % np.mean(fdr_array))
@@ -267,7 +499,10 @@ def experiment_nominal_control(control_type='scores', n_splits=[20],
                 print('fwer: %0.3f' % np.mean(fdr_array > 0))
 
 
-def experiment_roc_curve(model_selection='multivariate', roc_type='scores'):
+def experiment_roc_curve(model_selection='multivariate', roc_type='scores',
+                         n_jobs=1, store=None, alphas=ALPHAS):
+    """ROC (or precision-recall, if roc_type is 'pr') curves of the
+    detection of the true coefficients, accumulated over the tests"""
     # set various parameters
     n_samples = 100
     n_test = 20
@@ -277,37 +512,34 @@ def experiment_roc_curve(model_selection='multivariate', roc_type='scores'):
     rs_start = 1
 
     ax = plt.subplot(111)
+    size = np.prod(SHAPE)
     for n_split in [1, 20]:
         for mean_size_clust in [1, 5, 10]:
+            n_clusters = size / mean_size_clust
+            accumulator = DetectionAccumulator(
+                size=1. if roc_type == 'pvals' else size, alphas=alphas,
+                select=_fdr_selection(model_selection))
             # fdr, recall, pval, score, true_coeff
-            res = Parallel(n_jobs=1)(
-                delayed(stat_test)(model_selection=model_selection,
-                              n_samples=n_samples,
-                              n_split=n_split,
-                              split_ratio=split_ratio,
-                              mean_size_clust=mean_size_clust,
-                              theta=theta,
-                              snr=snr,
-                              random_seed=rs_start + i,
-                              print_results=False,
-                              plot=False) for i in range(n_test))
-            pvals = [res_[2] for res_ in res]
-            scores = [res_[3] for res_ in res]
-            true_coeffs = [res_[4] for res_ in res]
-            n_clusters = pvals[0].size / mean_size_clust
-
-            if roc_type == 'pvals':
-                fpr, tpr, thresholds = roc_curve(
-                    np.concatenate(true_coeffs, 1),
-                    1 - np.concatenate(pvals, 1))
-            elif roc_type == 'scores':
-                fpr, tpr, thresholds = roc_curve(
-                    np.concatenate(true_coeffs, 1).ravel(),
-                    true_coeffs[0].size - np.concatenate(scores))
-            elif roc_type == 'pr':
-                fpr, tpr, _ = precision_recall_curve(
-                    np.concatenate(true_coeffs, 1).ravel(),
-                    true_coeffs[0].size - np.concatenate(scores))
+            for res_ in iter_stat_test(
+                    n_test, rs_start=rs_start, n_jobs=n_jobs, store=store,
+                    model_selection=model_selection,
+                    n_samples=n_samples,
+                    n_split=n_split,
+                    split_ratio=split_ratio,
+                    mean_size_clust=mean_size_clust,
+                    theta=theta,
+                    snr=snr,
+                    plot=False):
+                accumulator.add(res_[2] if roc_type == 'pvals' else res_[3],
+                                res_[4])
+
+            if roc_type == 'pr':
+                fpr, tpr, _ = accumulator.precision_recall_curve()
+            else:
+                fpr, tpr, _ = accumulator.roc_curve()
+            print('model selection %s, n_split %d, %d clusters' % (
+                model_selection, n_split, n_clusters))
+            _print_fdr_recall(accumulator)
             linewidth = 1
             if model_selection == 'multivariate':
                 linewidth = 2
@@ -322,7 +554,9 @@ def experiment_roc_curve(model_selection='multivariate', roc_type='scores'):
     ax.set_title('ROC curves. split ratio = %1.1f' % split_ratio)
 
 
-def anova_curve(roc_type='scores'):
+def anova_curve(roc_type='scores', n_jobs=1, store=None, alphas=ALPHAS):
+    """ROC (or precision-recall, if roc_type is not 'scores') curve of
+    the anova, accumulated over the tests"""
     # set various parameters
     n_samples = 100
     n_test = 20
@@ -331,24 +565,22 @@ def anova_curve(roc_type='scores'):
 
     ax = plt.subplot(111)
     # collect results
-    pvals = []
-    scores = []
-    true_coeffs = []
-    for i in range(n_test):
-        fdr, recall, pval, score, true_coeff = stat_test(
+    accumulator = DetectionAccumulator(alphas=alphas,
+                                       select=_fdr_selection('anova'))
+    for res_ in iter_stat_test(
+            n_test, rs_start=rs_start, n_jobs=n_jobs, store=store,
             model_selection='anova',
             n_samples=n_samples,
             snr=snr,
-            random_seed=rs_start + i,
-            print_results=False,
-            plot=False)
-        pvals.append(pval)
-        scores.append(score)
-        true_coeffs.append(true_coeff.ravel())
-
-    curve = roc_curve if roc_type == 'scores' else precision_recall_curve
-    fpr, tpr, _ = curve(
-        np.concatenate(true_coeffs), 1 - np.concatenate(pvals))
+            plot=False):
+        accumulator.add(res_[2], res_[4])
+
+    if roc_type == 'scores':
+        fpr, tpr, _ = accumulator.roc_curve()
+    else:
+        fpr, tpr, _ = accumulator.precision_recall_curve()
+    print('anova')
+    _print_fdr_recall(accumulator)
     ax.plot(fpr, tpr, '--', label='anova')
     ax.plot([0, 1], [0, 1], 'k--')
     ax.set_xlim([0.0, 1.0])
@@ -0,0 +1,126 @@
+""" Geometry of a brain mask: the voxel connectivity graph and its edges
+
+The same spatial graph is used by the ward and fast clusterings and by the
+experiments. It is built once per mask and cached in memory, and
+optionally on disk.
+"""
+
+import os
+import hashlib
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+_CACHE = {}
+_CACHE_SIZE = 8
+
+
+def _masked_edges(mask):
+    """ Edges between neighboring voxels of a 3D mask
+
+    The voxels are indexed as in the masked data (C order), and the edges
+    are returned as a (2, n_edges) int32 array.
+    """
+    mask = np.asarray(mask).astype(bool)
+    index = - np.ones(mask.shape, dtype=np.int32)
+    index[mask] = np.arange(mask.sum(), dtype=np.int32)
+
+    edges = []
+    for axis in (2, 1, 0):
+        start = [slice(None)] * 3
+        stop = [slice(None)] * 3
+        start[axis] = slice(None, -1)
+        stop[axis] = slice(1, None)
+        i_idx = index[tuple(start)].ravel()
+        j_idx = index[tuple(stop)].ravel()
+        in_mask = np.logical_and(i_idx >= 0, j_idx >= 0)
+        edges.append(np.vstack((i_idx[in_mask], j_idx[in_mask])))
+    return np.hstack(edges)
+
+
+def mask_key(mask):
+    """ Hash of the shape and the content of a mask"""
+    mask = np.ascontiguousarray(np.asarray(mask).astype(bool))
+    sha = hashlib.sha1(str(mask.shape).encode('ascii'))
+    sha.update(np.packbits(mask).tobytes())
+    return sha.hexdigest()
+
+
+class MaskGeometry(object):
+    """ Connectivity graph of the voxels of a 3D mask
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the mask
+
+    key : string
+        Hash of the mask
+
+    n_voxels : int
+        Number of voxels in the mask
+
+    edges : np.int32((2, n_edges))
+        Pairs of neighboring voxels, indexed as the masked data
+
+    connectivity : sparse matrix (n_voxels, n_voxels)
+        CSR connectivity, identical to image.grid_to_graph(mask=mask)
+    """
+
+    def __init__(self, mask=None, key=None, edges=None, n_voxels=None):
+        if mask is not None:
+            mask = np.asarray(mask).astype(bool)
+            key = mask_key(mask)
+            edges = _masked_edges(mask)
+            n_voxels = int(mask.sum())
+        self.key = key
+        self.edges = edges
+        self.n_voxels = n_voxels
+
+        diagonal = np.arange(n_voxels)
+        connectivity = coo_matrix(
+            (np.ones(2 * edges.shape[1] + n_voxels, dtype=np.int64),
+             (np.hstack((edges[0], edges[1], diagonal)),
+              np.hstack((edges[1], edges[0], diagonal)))),
+            shape=(n_voxels, n_voxels))
+        self.connectivity = csr_matrix(connectivity)
+
+    def save(self, filename):
+        np.savez(filename, key=np.array(self.key), edges=self.edges,
+                 n_voxels=self.n_voxels)
+
+    @classmethod
+    def load(cls, filename):
+        archive = np.load(filename)
+        return cls(key=str(archive['key']), edges=archive['edges'],
+                   n_voxels=int(archive['n_voxels']))
+
+
+def get_mask_geometry(mask, cachedir=None):
+    """ MaskGeometry of a 3D mask, computed once per mask
+
+    mask : np.bool((n_x, n_y, n_z))
+        The mask, e.g. nifti_masker.mask_img_.get_data()
+
+    cachedir : string, optional
+        Directory where the geometries are also cached on disk
+    """
+    key = mask_key(mask)
+    if key in _CACHE:
+        return _CACHE[key]
+
+    filename = None
+    if cachedir is not None:
+        filename = os.path.join(cachedir, 'mask_geometry_%s.npz' % key)
+    if filename is not None and os.path.exists(filename):
+        geometry = MaskGeometry.load(filename)
+    else:
+        geometry = MaskGeometry(mask)
+        if filename is not None:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            geometry.save(filename)
+
+    if len(_CACHE) >= _CACHE_SIZE:
+        _CACHE.pop(next(iter(_CACHE)))
+    _CACHE[key] = geometry
+    return geometry
@@ -0,0 +1,149 @@
+"""
+Stability lasso on many subjects of the Haxby dataset
+=====================================================
+
+Masking a 4D run is bound by I/O and decompression, and fitting the
+StabilityLasso by computation: the next subjects are loaded and masked in
+a background thread while the current one is fitted, so that both stages
+run at the same time. At most max_prefetch subjects are loaded ahead of
+the one being fitted, and the outputs of each subject are written as soon
+as it is done::
+
+    python multi_subject.py [output_dir] [n_subjects]
+"""
+
+import os
+import sys
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+
+from mask_geometry import get_mask_geometry
+
+_DONE = object()
+
+
+def prefetch(load, items, max_prefetch=1):
+    """Yield (item, load(item)) for each item, loading ahead in a thread
+
+    At most max_prefetch items are loaded ahead, counting the one being
+    loaded, so that at most max_prefetch + 1 loaded items are in memory
+    with the one being consumed. An exception raised by load is raised
+    again in the consumer.
+    """
+    queue = Queue()
+    # one slot per item loaded ahead, freed when the item is consumed
+    slots = threading.Semaphore(max_prefetch)
+
+    def producer():
+        try:
+            for item in items:
+                slots.acquire()
+                queue.put((item, load(item), None))
+        except BaseException as error:
+            queue.put((None, None, error))
+        queue.put(_DONE)
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    while True:
+        loaded = queue.get()
+        if loaded is _DONE:
+            break
+        item, data, error = loaded
+        if error is not None:
+            raise error
+        slots.release()
+        yield item, data
+    thread.join()
+
+
+def load_subject(subject, conditions=(b'face', b'house'), memory='cache'):
+    """Masked samples of the given conditions of a run
+
+    subject : dict
+        With the 'func', 'session_target' and 'mask' filenames of the run,
+        and optionally 'smoothing_fwhm'
+
+    Returns X, the targets, the sessions and the fitted NiftiMasker
+    """
+    from nilearn.input_data import NiftiMasker
+    labels = np.recfromcsv(subject['session_target'], delimiter=" ")
+    _, target = np.unique(labels['labels'], return_inverse=True)
+    condition_mask = np.in1d(labels['labels'], conditions)
+
+    masker = NiftiMasker(mask_img=subject['mask'], standardize=True,
+                         smoothing_fwhm=subject.get('smoothing_fwhm'),
+                         memory=memory)
+    X = masker.fit_transform(subject['func'])[condition_mask]
+    return (X, target[condition_mask], labels['chunks'][condition_mask],
+            masker)
+
+
+def fit_subject(X, y, connectivity, theta=.1, n_split=10, n_clusters=2000):
+    """Outputs of the StabilityLasso of one subject, as a dict of arrays"""
+    from stab_lasso import StabilityLasso
+    model = StabilityLasso(theta=theta, n_split=n_split,
+                           n_clusters=n_clusters)
+    model.fit(X, y, connectivity=connectivity)
+    return {'coef': model.coef_,
+            'pvalues': model.multivariate_split_pval(X, y)}
+
+
+def run_subjects(subjects, output_dir, load=load_subject, fit=fit_subject,
+                 max_prefetch=1, cachedir='cache', verbose=1):
+    """Load, fit and save each subject, loading the next ones meanwhile
+
+    subjects : list of dict
+        One dict per subject or run, with a 'name' and what load needs
+
+    load : callable, optional
+        load(subject) returns X, y, the sessions and the NiftiMasker
+
+    fit : callable, optional
+        fit(X, y, connectivity) returns a dict of arrays. The arrays of
+        the voxels are also saved as images.
+
+    Writes <name>.npz and <name>_<output>.nii.gz in output_dir, and returns
+    the names of the subjects done.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    done = []
+    for subject, (X, y, _, masker) in prefetch(load, subjects,
+                                               max_prefetch):
+        mask = masker.mask_img_.get_data()
+        connectivity = get_mask_geometry(mask, cachedir=cachedir).connectivity
+        outputs = fit(X, y, connectivity)
+        name = subject['name']
+        np.savez(os.path.join(output_dir, '%s.npz' % name), **outputs)
+        for output, value in outputs.items():
+            if np.shape(value) == (X.shape[1],):
+                masker.inverse_transform(value).to_filename(os.path.join(
+                    output_dir, '%s_%s.nii.gz' % (name, output)))
+        done.append(name)
+        if verbose:
+            print('%s done: %d samples, %d voxels' % (name, X.shape[0],
+                                                      X.shape[1]))
+    return done
+
+
+def haxby_subjects(n_subjects=6):
+    """Subjects of the Haxby dataset, fetched with nilearn"""
+    from nilearn import datasets
+    haxby_dataset = datasets.fetch_haxby(n_subjects=n_subjects)
+    return [{'name': 'subj%d' % (i + 1), 'func': func,
+             'session_target': session_target, 'mask': haxby_dataset.mask}
+            for i, (func, session_target) in enumerate(
+                zip(haxby_dataset.func, haxby_dataset.session_target))]
+
+
+if __name__ == '__main__':
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else 'subjects'
+    n_subjects = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    run_subjects(haxby_subjects(n_subjects), output_dir)
@@ -0,0 +1,93 @@
+""" Visualization of the fast clustering on the Haxby dataset
+
+The deprecated reduction functions below are used only for visualization
+of the method; they are kept out of fast_cluster so that importing it
+does not load matplotlib or nilearn.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix, dia_matrix
+
+from base_clustering import _check_parcelation_results
+from fast_cluster import ReNN
+
+### XXX Deprecated functions ###################################################
+
+def fmri_reduction(data, labels, return_mat=False):
+    """Fast cluster-based reduction of data array """
+    n_voxels = data.shape[-1]
+    n_parcels = len(np.unique(labels))
+
+    parcellation_masks = coo_matrix(
+        (np.ones(n_voxels), (labels, np.arange(n_voxels))),
+        shape=(n_parcels, n_voxels),
+        dtype=np.float32).tocsc()
+
+    inv_sum_col = dia_matrix(
+        (np.array(1. / parcellation_masks.sum(1)).squeeze(), 0),
+        shape=(n_parcels, n_parcels))
+
+    parcellation_masks = inv_sum_col * parcellation_masks
+    fmri_reduced = parcellation_masks * data.T
+    if return_mat:
+        return fmri_reduced.T, parcellation_masks
+    return fmri_reduced.T
+
+
+def fmri_compression(data, labels, n_clusters):
+    """Fast cluster-based compression of data array"""
+    labels = _check_parcelation_results(labels, n_clusters)
+    fmri_reduced = fmri_reduction(data, labels)
+    fmri_compressed = np.array(fmri_reduced.T[labels])
+    return fmri_compressed
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_stat_map, plot_roi, plot_epi
+    from nilearn import datasets
+    from nilearn.input_data import NiftiMasker
+
+    plt.close('all')
+
+    data_dir = '/volatile/andres/brain_codes/DATA/nilearn_data'
+    data_dir = None
+    dataset = datasets.fetch_haxby(data_dir=data_dir, n_subjects=1)
+
+    masker = NiftiMasker(mask_strategy='epi', smoothing_fwhm=6, memory='cache')
+    X = masker.fit_transform(dataset.func[0])
+
+    # cluster = KMeans(n_clusters=5)
+    cluster = ReNN(masker=masker, scaling=False, n_clusters=2000,
+                   linkage='fast',
+                             # linkage='single',
+                             # random=True,
+                             )
+
+    # # Test random projection
+    # random_projection = SRandomProjections(n_clusters=100)
+    # Xred = random_projection.fit_transform(X)
+
+    Xred = cluster.fit_transform(X[0: 10])
+    Xcomp = cluster.inverse_transform(Xred)
+
+    cut_coords = (10, -10, 0)
+
+    plot_epi(masker.inverse_transform(Xcomp[0]), title='compressed',
+             display_mode='ortho', cut_coords=cut_coords)
+    plot_epi(masker.inverse_transform(X[0]), title='original',
+             display_mode='ortho', cut_coords=cut_coords)
+
+     # Shuffle the labels (for better visualization):
+    labels = cluster.labels_
+    permutation = np.random.permutation(labels.shape[0])
+    labels = permutation[labels]
+    labels_img_ = masker.inverse_transform(labels)
+
+    plot_stat_map(labels_img_, bg_img=dataset.anat[0], title='clusters',
+                  display_mode='ortho', cut_coords=cut_coords, colorbar=False)
+    plt.show()
+
+    np.testing.assert_almost_equal(Xred[0], cluster.transform(Xcomp)[0])
+
+
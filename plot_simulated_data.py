@@ -34,8 +34,69 @@ def generate_w(shape, roi_size):
       (shape[2] - roi_size) // 2:(shape[2] + roi_size) // 2, 4] = 0.5
     return w
 
+def smooth_volumes(volumes, sigma, method='direct'):
+    """Gaussian smoothing of each volume of a (n_samples,) + shape array
+
+    method : 'direct' or 'fft', optional
+        'direct' filters all the volumes in one gaussian_filter call, with
+        a zero sigma on the sample axis: it is identical to filtering the
+        volumes one by one. 'fft' multiplies by the gaussian in the Fourier
+        domain, which is faster for large sigmas and shapes, but has
+        periodic boundaries.
+    """
+    sigma = (0,) + (sigma,) * (volumes.ndim - 1)
+    if method == 'direct':
+        return ndimage.gaussian_filter(volumes, sigma)
+    elif method == 'fft':
+        axes = tuple(range(1, volumes.ndim))
+        volumes_f = np.fft.rfftn(volumes, axes=axes)
+        volumes_f = ndimage.fourier_gaussian(volumes_f, sigma,
+                                             n=volumes.shape[-1], axis=-1)
+        return np.fft.irfftn(volumes_f, s=volumes.shape[1:], axes=axes)
+    raise ValueError("Unknown smoothing method: %s" % method)
+
+
+def smooth_noise(generator, n_samples, shape, smooth_X=1, method='direct',
+                 dtype=np.float64, out=None, batch_size=None):
+    """Smooth gaussian noise volumes, as a (n_samples, n_voxels) array
+
+    The volumes are drawn from generator and smoothed by batches, so that
+    only out is allocated for the whole data: the result is the same as
+    drawing and smoothing all of them at once.
+
+    out : np.array((n_samples, n_voxels)), optional
+        Preallocated output, e.g. a np.memmap. Its dtype overrides dtype.
+
+    batch_size : int, optional
+        Number of volumes smoothed at a time, by default about 4M values
+    """
+    n_voxels = int(np.prod(shape))
+    if out is None:
+        out = np.empty((n_samples, n_voxels), dtype=dtype)
+    if batch_size is None:
+        batch_size = max(1, 2 ** 22 // n_voxels)
+    for start in range(0, n_samples, batch_size):
+        stop = min(start + batch_size, n_samples)
+        volumes = generator.randn(stop - start, *shape)
+        out[start:stop] = smooth_volumes(volumes, smooth_X, method).reshape(
+            stop - start, n_voxels)
+    return out
+
+
 def univariate_simulation(snr=0, n_samples=200, shape=SHAPE, random_state=1,
-                          modulation=False, roi_size=ROI_SIZE, smooth_X=1):
+                          modulation=False, roi_size=ROI_SIZE, smooth_X=1,
+                          smooth_method='direct', dtype=np.float64, out=None):
+    """Simulated data whose voxels in the ROIs are correlated with y
+
+    smooth_method : 'direct' or 'fft', optional
+        See smooth_volumes
+
+    dtype : np.float64 or np.float32, optional
+        dtype of X and noise
+
+    out : np.array((n_samples, n_voxels)), optional
+        Preallocated array in which X is written
+    """
     generator = check_random_state(random_state)
     w = generate_w(shape, roi_size)
     ### Coefs
@@ -45,14 +106,9 @@ def univariate_simulation(snr=0, n_samples=200, shape=SHAPE, random_state=1,
         w = w.sum(-1).ravel()[np.newaxis]
 
     ### Generate smooth background noise
-    X_ = generator.randn(n_samples, shape[0], shape[1], shape[2])
-    noise = []
-    for i in range(n_samples):
-        Xi = ndimage.filters.gaussian_filter(X_[i], smooth_X)
-        Xi = Xi.ravel()
-        noise.append(Xi)
-
-    noise = np.array(noise)
+    noise = smooth_noise(generator, n_samples, shape, smooth_X,
+                         method=smooth_method, dtype=dtype)
+
     ### Generate the signal y and X
     y_ = generator.randn(n_samples, 1)
     if modulation:
@@ -61,15 +117,20 @@ def univariate_simulation(snr=0, n_samples=200, shape=SHAPE, random_state=1,
     else:
         y = y_
 
-    X = np.dot(y, w)
+    signal = np.dot(y, w)
 
     ## Generate the noise
-    norm_noise = linalg.norm(X, 2) / np.exp(snr / 20.)
+    norm_noise = linalg.norm(signal, 2) / np.exp(snr / 20.)
     noise_coef = norm_noise / linalg.norm(noise[:, w.sum(0) != 0], 2)
     noise *= noise_coef
- 
+
     ### Mixing of signal + noise and splitting into train/test
     ## Old noising version
+    if out is None:
+        out = np.empty(noise.shape, dtype=dtype)
+    X = out
+    X[...] = signal
+    del signal
     X += noise
     X -= X.mean(axis=-1)[:, np.newaxis]
     X /= X.std(axis=-1)[:, np.newaxis]
@@ -77,19 +138,19 @@ def univariate_simulation(snr=0, n_samples=200, shape=SHAPE, random_state=1,
 
 
 def multivariate_simulation(snr=0, n_samples=200, shape=SHAPE, random_state=1,
-                          modulation=False, roi_size=ROI_SIZE, smooth_X=1):
+                          modulation=False, roi_size=ROI_SIZE, smooth_X=1,
+                          smooth_method='direct', dtype=np.float64, out=None):
+    """Simulated data where y is a linear function of the voxels in the ROIs
+
+    See univariate_simulation for smooth_method, dtype and out.
+    """
     generator = check_random_state(random_state)
     w = generate_w(shape, roi_size)
     w = w.sum(-1).ravel()[np.newaxis]
-    X_ = generator.randn(n_samples, shape[0], shape[1], shape[2])
-    X = []
-    for i in range(n_samples):
-        Xi = ndimage.filters.gaussian_filter(X_[i], smooth_X)
-        X.append(Xi.ravel())
-
-    X = np.array(X)
+    X = smooth_noise(generator, n_samples, shape, smooth_X,
+                     method=smooth_method, dtype=dtype, out=out)
     y = np.dot(X, w.T)
-    noise = np.random.randn(len(y), 1)
+    noise = generator.randn(len(y), 1)
     norm_noise = linalg.norm(y) / linalg.norm(noise) / np.exp(snr / 20.)
     y += (noise * norm_noise)
     return X, np.ravel(y), snr, noise, w.sum(0)[np.newaxis], shape
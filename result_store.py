@@ -0,0 +1,112 @@
+""" On-disk store of the results of the simulation experiments
+
+Each result of stat_test (fdr, recall, p-values, scores, true
+coefficients) is saved as a compressed .npz file named after a hash of
+its full parameters, seed included. index.json maps the hashes to the
+parameters. The files are written to a temporary name and renamed, so an
+interrupted sweep leaves no partial result: rerunning it only computes
+the missing cells, and re-plotting is a pure read.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+RESULT_FIELDS = ('fdr', 'recall', 'pvals', 'scores', 'true_coeff')
+
+
+def _normalize(value):
+    """JSON-able version of a parameter value"""
+    if isinstance(value, (tuple, list)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def params_key(params):
+    """Hash of a dict of parameters"""
+    params = dict((name, _normalize(value)) for name, value in params.items())
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def _atomic_write(filename, write):
+    """Call write(f) on a temporary file, then rename it to filename"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ResultStore(object):
+    """Results of the experiments on disk, keyed by their parameters
+
+    Parameters
+    ----------
+    directory : string
+        Where the results and the index are stored. It is created if needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _filename(self, params):
+        return os.path.join(self.directory, '%s.npz' % params_key(params))
+
+    def __contains__(self, params):
+        return os.path.exists(self._filename(params))
+
+    def get(self, params):
+        """The result stored for params, as a tuple in RESULT_FIELDS order"""
+        archive = np.load(self._filename(params))
+        result = tuple(archive[field] for field in RESULT_FIELDS)
+        return (float(result[0]), float(result[1])) + result[2:]
+
+    def put(self, params, result):
+        """Store a result, given as a tuple in RESULT_FIELDS order"""
+        arrays = dict(zip(RESULT_FIELDS, result))
+        arrays['params'] = np.array(json.dumps(
+            _normalize(params), sort_keys=True))
+        _atomic_write(self._filename(params),
+                      lambda f: np.savez_compressed(f, **arrays))
+
+    def index(self):
+        """{key: params} of the stored results"""
+        filename = os.path.join(self.directory, 'index.json')
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as f:
+            return json.load(f)
+
+    def update_index(self, params_list):
+        """Add the parameters of results stored by put to index.json"""
+        index = self.index()
+        for params in params_list:
+            index[params_key(params)] = dict(
+                (name, _normalize(value)) for name, value in params.items())
+        _atomic_write(os.path.join(self.directory, 'index.json'),
+                      lambda f: f.write(json.dumps(
+                          index, indent=1, sort_keys=True).encode('utf-8')))
+
+    def rebuild_index(self):
+        """Rewrite index.json from the stored results"""
+        params_list = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.npz'):
+                archive = np.load(os.path.join(self.directory, name))
+                params_list.append(json.loads(str(archive['params'])))
+        filename = os.path.join(self.directory, 'index.json')
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.update_index(params_list)
@@ -1,31 +1,52 @@
+import os
+import json
+import numbers
 import numpy as np
 from sklearn.linear_model import Lasso, LinearRegression
 from sklearn.cluster import FeatureAgglomeration, AgglomerativeClustering
 from sklearn.utils import check_random_state
 from scipy.stats import pearsonr
-import statsmodels.api as sm
 from scipy.sparse import coo_matrix, dia_matrix
 from sklearn.preprocessing import LabelBinarizer, StandardScaler
 from sklearn.linear_model.base import center_data
+from base_clustering import sketch_samples
+from instrumentation import StageProfiler, NULL_PROFILER
+from result_store import _atomic_write
 
 
-def projection(X, k, connectivity, ward=True):
+def projection(X, k, connectivity, ward=True, n_sketch=None,
+               sketch='gaussian', random_state=None, labels=None,
+               profiler=NULL_PROFILER, split=None):
     """
     Take the data, and returns a matrix, to reduce the dimension
     Returns, invP, (P.(X.T)).T and the underlying labels
+
+    If n_sketch is not None, the clustering is computed on a random
+    projection of the samples of X to n_sketch dimensions (see
+    base_clustering.sketch_samples); the reduction itself uses the full X.
+
+    If labels is not None, it is used instead of clustering X.
+
+    The clustering and the reduction are timed as the 'clustering' and
+    'pp_inv' stages of profiler (see instrumentation.StageProfiler).
     """
     n, p = X.shape
-    if ward:
-        clustering = FeatureAgglomeration(
-            linkage='ward', n_clusters=k, connectivity=connectivity)
-        labels = clustering.fit(X).labels_
-    else:
-        from fast_cluster import ReNN, recursive_nn
-        _, labels = recursive_nn(connectivity, X, n_clusters=k)
+    if labels is None:
+        with profiler.stage('clustering', split):
+            X_clust = sketch_samples(X, n_sketch, sketch=sketch,
+                                     random_state=random_state)
+            if ward:
+                clustering = FeatureAgglomeration(
+                    linkage='ward', n_clusters=k, connectivity=connectivity)
+                labels = clustering.fit(X_clust).labels_
+            else:
+                from fast_cluster import ReNN, recursive_nn
+                _, labels = recursive_nn(connectivity, X_clust, n_clusters=k)
 
     #
-    P, P_inv = pp_inv(labels)
-    X_proj = P.dot(X.T).T
+    with profiler.stage('pp_inv', split):
+        P, P_inv = pp_inv(labels)
+        X_proj = P.dot(X.T).T
     # should be done through clustering.transform, but there is an issue
     # with the normalization
     # X_proj = clustering.transform(X)
@@ -50,8 +71,10 @@ def pp_inv(clust):
 
 
 def multivariate_split_pval(X, y, n_split, size_split, n_clusters,
-                            beta_array, split_array, clust_array):
+                            beta_array, split_array, clust_array,
+                            profiler=NULL_PROFILER):
     """Main function to obtain p-values across splits """
+    import statsmodels.api as sm
     n, p = X.shape
     pvalues = np.ones((n_split, p))
     for i in range(n_split):
@@ -62,7 +85,8 @@ def multivariate_split_pval(X, y, n_split, size_split, n_clusters,
         X_test = X[~split]
 
         # projection
-        P, P_inv = pp_inv(clust_array[i])
+        with profiler.stage('pp_inv', i):
+            P, P_inv = pp_inv(clust_array[i])
 
         # get the support
         beta_proj = beta_array[i]
@@ -72,22 +96,26 @@ def multivariate_split_pval(X, y, n_split, size_split, n_clusters,
         X_model = X_test_proj[:, model_proj]
 
         # fit the model on test data to get p-values
-        res = sm.OLS(y_test, X_model).fit()
+        with profiler.stage('ols', i):
+            res = sm.OLS(y_test, X_model).fit()
         pvalues_proj = np.ones(n_clusters)
         pvalues_proj[model_proj] = np.clip(
             model_proj_size * res.pvalues, 0., 1.)
         pvalues[i] = P_inv.dot(pvalues_proj)
 
-    if n_split > 1:
-        pvalues_aggregated = pvalues_aggregation(pvalues)
-    else:
-        pvalues_aggregated = pvalues[0]
+    with profiler.stage('aggregation'):
+        if n_split > 1:
+            pvalues_aggregated = pvalues_aggregation(pvalues)
+        else:
+            pvalues_aggregated = pvalues[0]
     return pvalues, pvalues_aggregated
 
 
 def multivariate_split_scores(X, y, n_split, size_split, n_clusters,
-                              beta_array, split_array, clust_array):
+                              beta_array, split_array, clust_array,
+                              profiler=NULL_PROFILER):
     """Main function to obtain scores across splits """
+    import statsmodels.api as sm
     n, p = X.shape
     scores = np.ones((n_split, p))
     for i in range(n_split):
@@ -98,7 +126,8 @@ def multivariate_split_scores(X, y, n_split, size_split, n_clusters,
         X_test = X[~split]
 
         # projection
-        P, P_inv = pp_inv(clust_array[i])
+        with profiler.stage('pp_inv', i):
+            P, P_inv = pp_inv(clust_array[i])
 
         # get the support
         beta_proj = beta_array[i]
@@ -110,21 +139,23 @@ def multivariate_split_scores(X, y, n_split, size_split, n_clusters,
         X_model = X_test_proj[:, model_proj]
 
         # fit the model on test data to get p-values
-        res = sm.OLS(y_test, X_model).fit()
+        with profiler.stage('ols', i):
+            res = sm.OLS(y_test, X_model).fit()
         scores_proj = p * np.ones(n_clusters)
         scores_proj[model_proj] = model_size * res.pvalues
         scores[i] = P_inv.dot(scores_proj)
 
-    if n_split > 1:
-        scores_aggregated = scores_aggregation(scores)
-    else:
-        scores_aggregated = scores[0]
+    with profiler.stage('aggregation'):
+        if n_split > 1:
+            scores_aggregated = scores_aggregation(scores)
+        else:
+            scores_aggregated = scores[0]
     return scores, scores_aggregated
 
 
 def univariate_split_pval(X, y, n_split, size_split, n_clusters,
                           beta_array, split_array, clust_array,
-                          permute=False):
+                          permute=False, profiler=NULL_PROFILER):
     """Univariate p-values computation
     todo: replace permutations with analytical tests
     """
@@ -137,9 +168,10 @@ def univariate_split_pval(X, y, n_split, size_split, n_clusters,
         X_test = X[~split]
 
         # projection
-        P, P_inv = pp_inv(clust_array[i])
-        X_test_proj = P.dot(X_test.T).T
-        X_proj = P.dot(X.T).T
+        with profiler.stage('pp_inv', i):
+            P, P_inv = pp_inv(clust_array[i])
+            X_test_proj = P.dot(X_test.T).T
+            X_proj = P.dot(X.T).T
 
         if permute:
             n_perm = 10000
@@ -154,21 +186,23 @@ def univariate_split_pval(X, y, n_split, size_split, n_clusters,
         else:
             #pvalues_proj = np.array([pearsonr(y_test, x)[1]
             #                         for x in X_test_proj.T])
-            pvalues_proj = np.array([pearsonr(y, x)[1]
-                                     for x in X_proj.T])
+            with profiler.stage('univariate_tests', i):
+                pvalues_proj = np.array([pearsonr(y, x)[1]
+                                         for x in X_proj.T])
         pvalues[i] = P_inv.dot(pvalues_proj)
 
     pvalues = (pvalues * len(pvalues_proj)).clip(0, 1)
-    if n_split > 1:
-        pvalues_aggregated = pvalues_aggregation(pvalues)
-    else:
-        pvalues_aggregated = pvalues[0]
+    with profiler.stage('aggregation'):
+        if n_split > 1:
+            pvalues_aggregated = pvalues_aggregation(pvalues)
+        else:
+            pvalues_aggregated = pvalues[0]
     return pvalues, pvalues_aggregated
 
 
 def univariate_split_scores(X, y, n_split, size_split, n_clusters,
                            beta_array, split_array, clust_array,
-                           permute=False):
+                           permute=False, profiler=NULL_PROFILER):
     """Univariate p-values computation
     todo: replace permutations with analytical tests
     """
@@ -182,9 +216,9 @@ def univariate_split_scores(X, y, n_split, size_split, n_clusters,
         X_test = X[~split]
 
         # projection
-        P, P_inv = pp_inv(clust_array[i])
-
-        X_test_proj = P.dot(X_test.T).T
+        with profiler.stage('pp_inv', i):
+            P, P_inv = pp_inv(clust_array[i])
+            X_test_proj = P.dot(X_test.T).T
         corr_true = np.abs(np.dot(y_test, X_test_proj).reshape(
                 (n_clusters)))
 
@@ -196,14 +230,16 @@ def univariate_split_scores(X, y, n_split, size_split, n_clusters,
             corr_perm = np.abs(corr_perm)
             scores_proj = 1. / n_perm * (corr_true < corr_perm).sum(axis=0)
         else:
-            scores_proj = np.array([pearsonr(y_test, x)[1]
-                                    for x in X_test_proj.T])
+            with profiler.stage('univariate_tests', i):
+                scores_proj = np.array([pearsonr(y_test, x)[1]
+                                        for x in X_test_proj.T])
         scores[i, :] = P_inv.dot(scores_proj)
 
-    if n_split > 1:
-        pvalues_aggregated = pvalues_aggregation(scores)
-    else:
-        pvalues_aggregated = scores[0]
+    with profiler.stage('aggregation'):
+        if n_split > 1:
+            pvalues_aggregated = pvalues_aggregation(scores)
+        else:
+            pvalues_aggregated = scores[0]
     return scores, pvalues_aggregated
 
 
@@ -298,6 +334,95 @@ def select_model_fwer_bounds(pvalues):
     return np.clip(pvalues * p, 0., 1.)
 
 
+def split_schedule(n, n_split, size_split, random_state=None):
+    """Samples of the first part of each split, np.int((n_split, size_split))
+
+    The splits are drawn one after another from random_state, as in
+    StabilityLasso.fit: the schedule of a seed is the same on every machine.
+    """
+    generator = check_random_state(random_state)
+    split_array = np.zeros((n_split, int(size_split)), dtype=int)
+    for i in range(n_split):
+        split = generator.choice(n, int(size_split), replace=False)
+        split.sort()
+        split_array[i] = split
+    return split_array
+
+
+def average_solution(beta_array, clust_array):
+    """Average over the splits of the coefficients in the voxel space
+
+    The splits are summed in order, so that the same splits always give
+    the same bits, whether they were fitted at once or by shards.
+    """
+    soln = np.zeros(clust_array.shape[1])
+    for beta_proj, labels in zip(beta_array, clust_array):
+        _, P_inv = pp_inv(labels)
+        soln += P_inv.dot(beta_proj)
+    soln /= len(beta_array)
+    return soln
+
+
+# per-split statistics of the inference methods, and their aggregation
+SPLIT_STATISTICS = {
+    'multivariate_split_pval': (multivariate_split_pval,
+                                pvalues_aggregation),
+    'multivariate_split_scores': (multivariate_split_scores,
+                                  scores_aggregation),
+    'univariate_split_pval': (univariate_split_pval, pvalues_aggregation),
+}
+
+
+def merge_shards(filenames):
+    """StabilityLasso fitted from the shard files of StabilityLasso.fit_shard
+
+    The shards must come from the same estimator parameters and cover the
+    whole split schedule, in any order. The solution and the aggregated
+    statistics are identical to those of a single run over all the splits.
+    The per-split and aggregated statistics are stored in the
+    split_statistics_ attribute, as {name: (per_split, aggregated)}, and
+    as the attributes set by the inference methods.
+    """
+    shards = sorted((dict(np.load(filename)) for filename in filenames),
+                    key=lambda shard: int(shard['start']))
+    params = json.loads(str(shards[0]['params']))
+    stop = 0
+    for shard in shards:
+        if json.loads(str(shard['params'])) != params:
+            raise ValueError("The shards come from different estimators")
+        if int(shard['start']) != stop:
+            raise ValueError("Splits %d to %d are missing or duplicated" % (
+                stop, int(shard['start'])))
+        stop = int(shard['stop'])
+    if stop != params['n_split']:
+        raise ValueError("Splits %d to %d are missing" % (
+            stop, params['n_split']))
+
+    model = StabilityLasso(**params)
+    model.intercept_ = shards[0]['intercept_']
+    model.size_split = float(shards[0]['size_split'])
+    model.n_clusters_ = int(shards[0]['n_clusters_'])
+    model._set_solution(
+        *[np.concatenate([shard[name] for shard in shards])
+          for name in ('beta_array', 'split_array', 'clust_array')])
+
+    model.split_statistics_ = {}
+    for name, (_, aggregation) in sorted(SPLIT_STATISTICS.items()):
+        if not all(name in shard for shard in shards):
+            continue
+        per_split = np.concatenate([shard[name] for shard in shards])
+        if len(per_split) > 1:
+            aggregated = aggregation(per_split)
+        else:
+            aggregated = per_split[0]
+        model.split_statistics_[name] = (per_split, aggregated)
+        if name.endswith('scores'):
+            model._scores, model._scores_aggregated = per_split, aggregated
+        else:
+            model._pvalues, model._pvalues_aggregated = per_split, aggregated
+    return model
+
+
 def test_select_model_fdr_bounds():
     p = 100
     pvalues = np.random.uniform(size=p) ** 5
@@ -318,13 +443,81 @@ def test_select_model_fdr_bounds():
     return bool_array
 
 
+def test_checkpoint_resume():
+    """A fit interrupted after a checkpoint, then resumed, gives the result
+    and the generator state of an uninterrupted fit"""
+    import shutil
+    import tempfile
+    from sklearn.feature_extraction.image import grid_to_graph
+    rng = np.random.RandomState(0)
+    X = rng.randn(40, 64)
+    y = X[:, 0] + .1 * rng.randn(40)
+    connectivity = grid_to_graph(8, 8)
+    params = dict(theta=.1, n_split=6, n_clusters=10, random_state=3)
+    reference = StabilityLasso(**params).fit(X, y, connectivity)
+
+    def crash(stage, split, elapsed):
+        if stage == 'lasso' and split == 3:
+            raise KeyboardInterrupt
+
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        model = StabilityLasso(checkpoint_dir=checkpoint_dir,
+                               checkpoint_every=2, profile=True,
+                               callback=crash, **params)
+        try:
+            model.fit(X, y, connectivity)
+        except KeyboardInterrupt:
+            pass
+        model = StabilityLasso(checkpoint_dir=checkpoint_dir,
+                               checkpoint_every=2, **params)
+        model.fit(X, y, connectivity)
+    finally:
+        shutil.rmtree(checkpoint_dir)
+    np.testing.assert_array_equal(model.coef_, reference.coef_)
+    np.testing.assert_array_equal(model.generator.get_state()[1],
+                                  reference.generator.get_state()[1])
+    assert model.generator.get_state()[2] == \
+        reference.generator.get_state()[2]
+
+
+IMPORT_TIME_BUDGET = 1.
+
+
+def test_lazy_imports(budget=IMPORT_TIME_BUDGET):
+    """Importing the estimator and clustering modules must not load
+    matplotlib, nilearn or statsmodels, and must take less than budget
+    seconds on top of numpy, scipy and sklearn"""
+    import os
+    import sys
+    import subprocess
+    code = '\n'.join([
+        "import sys, time",
+        "import numpy, scipy.sparse, sklearn.linear_model, sklearn.cluster",
+        "t0 = time.time()",
+        "import stab_lasso, fast_cluster",
+        "print(time.time() - t0)",
+        "print(' '.join(m for m in ('matplotlib', 'nilearn', 'statsmodels')",
+        "               if m in sys.modules))"])
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = output.decode().split('\n')
+    elapsed, loaded = float(lines[0]), lines[1].strip()
+    assert loaded == '', "Heavy modules loaded at import: %s" % loaded
+    assert elapsed < budget, "Import took %.2fs (budget %.2fs)" % (
+        elapsed, budget)
+
+
 class StabilityLasso(LinearRegression):
 
     alpha = 0.05
 
     def __init__(self, theta, n_split=100, ratio_split=.5,
                  n_clusters='0.1', model_selection='multivariate',
-                 random_state=1):
+                 random_state=1, n_sketch=None, sketch='gaussian',
+                 profile=False, profile_memory=False, callback=None,
+                 checkpoint_dir=None, checkpoint_every=10):
         """
 
         Parameters
@@ -349,14 +542,57 @@ class StabilityLasso(LinearRegression):
             Connectivity matrix of the data, used for the spatial clustering
 
         model_selection: string, optional
+
+        n_sketch : int, optional
+            If not None, the clustering of each split is computed on a
+            random projection of its samples to n_sketch dimensions, with
+            a seed drawn from random_state after the splits
+
+        sketch : string, optional
+            Type of random projection used when n_sketch is set, one of
+            'gaussian' (default) or 'sparse'
+
+        profile : bool, optional
+            If True, the wall time and number of calls of each stage
+            (scaling, clustering, pp_inv, lasso, ols, univariate_tests,
+            aggregation), the Lasso iteration counts and convergence
+            warnings are recorded in the profile_ attribute, an
+            instrumentation.StageProfiler, by fit and the inference methods
+
+        profile_memory : bool, optional
+            If True (and profile is True), the peak memory of each stage and
+            split is recorded as well, with tracemalloc or, before Python
+            3.9, getrusage (see instrumentation.StageProfiler)
+
+        callback : callable, optional
+            If profile is True, called as callback(stage, split, elapsed) at
+            the end of each stage
+
+        checkpoint_dir : string, optional
+            If not None, fit saves the splits done so far in this directory
+            every checkpoint_every splits, in the format of fit_shard. A fit
+            with the same data, parameters and generator state, e.g. after
+            a crash, resumes from the last checkpoint, and gives the same
+            result as an uninterrupted fit.
+
+        checkpoint_every : int, optional
+            Number of splits between two checkpoints
         """
         self.theta = theta
         self.n_split = n_split
         self.ratio_split = ratio_split
+        self.random_state = random_state
         self.generator = check_random_state(random_state)
         self.n_clusters = n_clusters
-
-    def fit(self, X, y, connectivity=None, **lasso_args):
+        self.n_sketch = n_sketch
+        self.sketch = sketch
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.callback = callback
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+
+    def fit(self, X, y, connectivity=None, parcellations=None, **lasso_args):
         """
 
         X : np.float((n, p))
@@ -365,16 +601,125 @@ class StabilityLasso(LinearRegression):
         y : np.float(n)
             The target, in the model $y = X\beta$
 
+        parcellations : np.int((n_split, p)), optional
+            Precomputed labels, one parcellation per split, used instead of
+            clustering each split (see fast_cluster.random_parcellations).
+            Each of them must have the labels 0 to n_clusters_ - 1.
+        """
+        checkpoint = None
+        if self.checkpoint_dir is not None:
+            checkpoint = os.path.join(
+                self.checkpoint_dir, 'stability_lasso_%s.npz' %
+                self._fingerprint(X, y, connectivity, parcellations))
+        profiler = self._start_profiler()
+        X, y = self._scale(X, y, profiler)
+        self._check_parcellations(parcellations, X.shape[1])
+        split_array, seeds = self._schedule(X.shape[0], self.generator)
+        if checkpoint is None:
+            beta_array, clust_array = self._fit_splits(
+                X, y, split_array, 0, connectivity, parcellations, profiler,
+                seeds)
+        else:
+            beta_array, clust_array = self._fit_checkpointed(
+                X, y, split_array, connectivity, parcellations, profiler,
+                checkpoint, seeds)
+        self._set_solution(beta_array, split_array, clust_array)
+        return self
+
+    def _fingerprint(self, X, y, connectivity, parcellations):
+        """Hash of what the result of fit depends on"""
+        from joblib import hash
+        params = self._shard_params()
+        params.pop('random_state')
+        return hash((X, y, connectivity, parcellations, params,
+                     self.generator.get_state()))
+
+    def _fit_checkpointed(self, X, y, split_array, connectivity,
+                          parcellations, profiler, filename, seeds=None):
+        """_fit_splits, saving the splits done in filename every
+        checkpoint_every splits, and starting from the ones saved there"""
+        n_split, p = len(split_array), X.shape[1]
+        beta_array = np.zeros((n_split, self.n_clusters_))
+        clust_array = np.zeros((n_split, p), dtype=int)
+        done = 0
+        if os.path.exists(filename):
+            checkpoint = np.load(filename)
+            done = int(checkpoint['stop'])
+            if not np.array_equal(checkpoint['split_array'],
+                                  split_array[:done]):
+                raise ValueError("The checkpoint %s does not match the "
+                                 "splits of this fit" % filename)
+            beta_array[:done] = checkpoint['beta_array']
+            clust_array[:done] = checkpoint['clust_array']
+        elif not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        for start in range(done, n_split, self.checkpoint_every):
+            stop = min(start + self.checkpoint_every, n_split)
+            beta_array[start:stop], clust_array[start:stop] = \
+                self._fit_splits(X, y, split_array[start:stop], start,
+                                 connectivity, parcellations, profiler,
+                                 seeds)
+            # the generator needs no saving: a resumed fit draws the same
+            # schedule again, which leaves it in the same state
+            arrays = self._shard_arrays(0, stop, beta_array[:stop],
+                                        split_array[:stop],
+                                        clust_array[:stop])
+            _atomic_write(filename, lambda f: np.savez(f, **arrays))
+        return beta_array, clust_array
+
+    def fit_shard(self, X, y, start, stop, filename, connectivity=None,
+                  parcellations=None,
+                  inference=('multivariate_split_pval',)):
+        """Fit the splits start to stop - 1, and save them to filename
+
+        The splits are those of the schedule of random_state, which must be
+        an int: the shards of a schedule can run as independent jobs, on
+        any machine, and be combined with merge_shards.
+
+        inference : sequence of string, optional
+            Inference methods (see SPLIT_STATISTICS) whose per-split
+            statistics are computed on X, y and saved in the shard
         """
+        if not isinstance(self.random_state, numbers.Integral):
+            raise ValueError("fit_shard needs an int random_state, got %r"
+                             % (self.random_state,))
+        profiler = self._start_profiler()
+        X_scaled, y_scaled = self._scale(X, y, profiler)
+        self._check_parcellations(parcellations, X.shape[1])
+        split_array, seeds = self._schedule(X.shape[0], self.random_state)
+        split_array = split_array[start:stop]
+        beta_array, clust_array = self._fit_splits(
+            X_scaled, y_scaled, split_array, start, connectivity,
+            parcellations, profiler, seeds)
+        arrays = self._shard_arrays(start, stop, beta_array, split_array,
+                                    clust_array)
+        for name in inference:
+            arrays[name], _ = SPLIT_STATISTICS[name][0](
+                X, y, stop - start, self.size_split, self.n_clusters_,
+                beta_array, split_array, clust_array, profiler=profiler)
+        _atomic_write(filename, lambda f: np.savez(f, **arrays))
+        return self
+
+    def _start_profiler(self):
+        if not self.profile:
+            self.__dict__.pop('profile_', None)
+            return NULL_PROFILER
+        self.profile_ = StageProfiler(callback=self.callback,
+                                      memory=self.profile_memory)
+        return self.profile_
+
+    def _scale(self, X, y, profiler):
+        """Standardized X and y, and the sizes that depend on X"""
         # X, y, X_mean, y_mean, X_std = center_data(
         #    X, y, True, True, True)
-        st = StandardScaler()
-        y = st.fit_transform(y.reshape(-1, 1))
-        self.intercept_ = st.mean_
-        X = st.fit_transform(X)
+        with profiler.stage('scaling'):
+            st = StandardScaler()
+            y = st.fit_transform(y.reshape(-1, 1))
+            self.intercept_ = st.mean_
+            X = st.fit_transform(X)
 
         n, p = X.shape
-        n_split = self.n_split
         self.size_split = n * self.ratio_split
         self.n_clusters_ = self.n_clusters
         if isinstance(self.n_clusters, basestring):
@@ -383,42 +728,110 @@ class StabilityLasso(LinearRegression):
             else:
                 self.n_clusters_ = int(eval('%s * p' % self.n_clusters_,
                                         dict(p=p)))
+        return X, y
+
+    def _check_parcellations(self, parcellations, p):
+        """Raise a ValueError if parcellations does not give the labels 0 to
+        n_clusters_ - 1 for each split"""
+        if parcellations is None:
+            return
+        parcellations = np.asarray(parcellations)
+        if parcellations.shape != (self.n_split, p):
+            raise ValueError("parcellations should have a shape (n_split, p) "
+                             "= %s, got %s" % ((self.n_split, p),
+                                               parcellations.shape))
+        for i, labels in enumerate(parcellations):
+            n_labels = len(np.unique(labels))
+            if (n_labels != self.n_clusters_ or labels.min() != 0 or
+                    labels.max() != self.n_clusters_ - 1):
+                raise ValueError(
+                    "The parcellation of split %d has %d labels from %d to "
+                    "%d, while n_clusters_ is %d" % (
+                        i, n_labels, labels.min(), labels.max(),
+                        self.n_clusters_))
+
+    def _schedule(self, n, random_state):
+        """Samples of the splits, and seeds of their sketches if n_sketch is
+        set, drawn from random_state"""
+        generator = check_random_state(random_state)
+        split_array = split_schedule(n, self.n_split, self.size_split,
+                                     generator)
+        seeds = None
+        if self.n_sketch is not None:
+            # drawn after the splits, which do not depend on n_sketch
+            seeds = generator.randint(np.iinfo(np.int32).max,
+                                      size=self.n_split)
+        return split_array, seeds
+
+    def _fit_splits(self, X, y, split_array, start, connectivity,
+                    parcellations, profiler, seeds=None):
+        """Clustering and Lasso of the splits start, start + 1, ...
+
+        seeds are the seeds of the sketches of all the splits.
+        """
+        n, p = X.shape
         theta = self.theta
+        beta_array = np.zeros((len(split_array), self.n_clusters_))
+        clust_array = np.zeros((len(split_array), p), dtype=int)
 
-        beta_array = np.zeros((n_split, self.n_clusters_))
-        split_array = np.zeros((n_split, self.size_split), dtype=int)
-        clust_array = np.zeros((n_split, p), dtype=int)
-        self._soln = np.zeros(p)
-
-        for i in range(n_split):
-            split = self.generator.choice(n, self.size_split, replace=False)
-            split.sort()
-
+        for j, split in enumerate(split_array):
+            i = start + j
             y_splitted, X_splitted = y[split], X[split]
             P_inv, X_proj, labels = projection(
-                X_splitted, self.n_clusters_, connectivity)
-            alpha = theta * np.max(np.abs(np.dot(X_proj.T, y_splitted))) / n
-            lasso_splitted = Lasso(alpha=alpha)
-            lasso_splitted.fit(X_proj, y_splitted)
-            beta_proj = lasso_splitted.coef_
-            beta = P_inv.dot(beta_proj)
-
-            beta_array[i] = beta_proj
-            split_array[i] = split
-            clust_array[i] = labels
-            self._soln += beta
-
-        self._soln /= n_split
+                X_splitted, self.n_clusters_, connectivity,
+                n_sketch=self.n_sketch, sketch=self.sketch,
+                random_state=None if seeds is None else seeds[i],
+                labels=None if parcellations is None else parcellations[i],
+                profiler=profiler, split=i)
+            with profiler.stage('lasso', i, record_warnings=True):
+                alpha = theta * np.max(
+                    np.abs(np.dot(X_proj.T, y_splitted))) / n
+                lasso_splitted = Lasso(alpha=alpha)
+                lasso_splitted.fit(X_proj, y_splitted)
+            profiler.lasso_iterations(lasso_splitted.n_iter_)
+
+            beta_array[j] = lasso_splitted.coef_
+            clust_array[j] = labels
+        return beta_array, clust_array
+
+    def _set_solution(self, beta_array, split_array, clust_array):
+        self._soln = average_solution(beta_array, clust_array)
         self._beta_array = beta_array
         self._split_array = split_array
         self._clust_array = clust_array
         self.coef_ = self._soln
-        return self
+
+    def _shard_params(self):
+        """Parameters of the estimator that its splits depend on"""
+        random_state = self.random_state
+        if isinstance(random_state, numbers.Integral):
+            random_state = int(random_state)
+        elif random_state is not None:
+            # only the seed of a schedule can be saved
+            random_state = None
+        return {'theta': self.theta, 'n_split': self.n_split,
+                'ratio_split': self.ratio_split,
+                'n_clusters': self.n_clusters,
+                'random_state': random_state,
+                'n_sketch': self.n_sketch, 'sketch': self.sketch}
+
+    def _shard_arrays(self, start, stop, beta_array, split_array,
+                      clust_array):
+        """Content of a shard file, see fit_shard"""
+        params = self._shard_params()
+        return {'params': np.array(json.dumps(params, sort_keys=True)),
+                'start': start, 'stop': stop,
+                'intercept_': self.intercept_,
+                'size_split': self.size_split,
+                'n_clusters_': self.n_clusters_,
+                'beta_array': beta_array, 'split_array': split_array,
+                'clust_array': clust_array}
 
     def multivariate_split_pval(self, X, y):
         pvalues, pvalues_aggregated = multivariate_split_pval(
             X, y, self.n_split, self.size_split, self.n_clusters_,
-            self._beta_array, self._split_array, self._clust_array)
+            self._beta_array, self._split_array, self._clust_array,
+            profiler=self._profiler())
         self._pvalues = pvalues
         self._pvalues_aggregated = pvalues_aggregated
         return pvalues_aggregated
@@ -426,7 +839,8 @@ class StabilityLasso(LinearRegression):
     def multivariate_split_scores(self, X, y):
         scores, scores_aggregated = multivariate_split_scores(
             X, y, self.n_split, self.size_split, self.n_clusters_,
-            self._beta_array, self._split_array, self._clust_array)
+            self._beta_array, self._split_array, self._clust_array,
+            profiler=self._profiler())
         self._scores = scores
         self._scores_aggregated = scores_aggregated
         return scores_aggregated
@@ -434,11 +848,15 @@ class StabilityLasso(LinearRegression):
     def univariate_split_pval(self, X, y):
         pvalues, pvalues_aggregated = univariate_split_pval(
             X, y, self.n_split, self.size_split, self.n_clusters_,
-            self._beta_array, self._split_array, self._clust_array)
+            self._beta_array, self._split_array, self._clust_array,
+            profiler=self._profiler())
         self._pvalues = pvalues
         self._pvalues_aggregated = pvalues_aggregated
         return pvalues_aggregated
 
+    def _profiler(self):
+        return getattr(self, 'profile_', NULL_PROFILER)
+
     def select_model_fwer(self, alpha):
         p, = self._pvalues_aggregated.shape
         return self._pvalues_aggregated < (alpha / p)